@@ -1,10 +1,26 @@
-from __future__ import absolute_import
+from __future__ import absolute_import, print_function
 
-from .cli import parse_args
+import os
+import sys
 
 __version__ = '0.2.0'
 
 
 def run():
+    # Let the warm daemon (if running) execute the command
+    if not os.environ.get('EC2_NO_DAEMON'):
+        from .daemon import forward
+        exit_code = forward(sys.argv[1:])
+        if exit_code is not None:
+            sys.exit(exit_code)
+
+    from . import utils
+    from .cli import parse_args
+    from .exceptions import Ec2Error
+
     args = parse_args()
-    args.cmd(args)
+    try:
+        args.cmd(args)
+    except Ec2Error as e:
+        print("{}ERROR{}: {}".format(utils.ERROR_COLOR, utils.RESET_COLOR, e))
+        sys.exit(1)
@@ -0,0 +1,171 @@
+"""
+On-instance spot interruption agent.
+
+The agent polls the instance metadata service for a spot interruption notice.
+Once AWS announces that the instance is about to be reclaimed, the agent runs
+a checkpoint hook (e.g., flushes the work to the project's EFS) and appends
+the event to a log that `ec2 fleet watch` streams back to the user.
+
+The module depends on the standard library only, so that it can be copied to
+a bare instance and executed there as a standalone script.
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+
+METADATA_URL = "http://169.254.169.254"
+EVENTS_PATH = "/var/log/ec2-agent/events.log"
+REMOTE_PATH = "/opt/ec2/agent.py"
+PID_PATH = "/opt/ec2/agent.pid"
+
+_TOKEN_TTL = 21600
+
+
+class MetadataClient(object):
+    """A tiny client of the instance metadata service (IMDSv1 and IMDSv2)."""
+
+    def __init__(self, metadata_url=METADATA_URL, timeout=1.0):
+        self.metadata_url = metadata_url.rstrip("/")
+        self.timeout = timeout
+        self._token = None
+        self._token_expires = 0.0
+
+    def _refresh_token(self):
+        request = Request(
+            self.metadata_url + "/latest/api/token",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": str(_TOKEN_TTL)})
+        request.get_method = lambda : "PUT"
+        try:
+            self._token = urlopen(
+                request, timeout=self.timeout).read().decode("utf-8")
+            self._token_expires = time.time() + _TOKEN_TTL - 60
+        except (HTTPError, URLError, socket.error):
+            # Fall back to IMDSv1 if tokens are not supported.
+            self._token = None
+            self._token_expires = time.time() + 60
+
+    def get(self, path):
+        """Returns the body of a metadata path or None if it is missing."""
+        if time.time() >= self._token_expires:
+            self._refresh_token()
+        headers = {}
+        if self._token is not None:
+            headers["X-aws-ec2-metadata-token"] = self._token
+        request = Request(
+            self.metadata_url + "/latest/meta-data/" + path, headers=headers)
+        try:
+            body = urlopen(request, timeout=self.timeout).read()
+        except HTTPError as e:
+            if e.code == 401:
+                self._token_expires = 0.0
+            if e.code in (401, 404):
+                return None
+            raise
+        return body.decode("utf-8")
+
+    def instance_action(self):
+        """Returns the pending spot instance action or None."""
+        body = self.get("spot/instance-action")
+        if body is None:
+            return None
+        return json.loads(body)
+
+
+def report(event, events_path=EVENTS_PATH):
+    """Appends an event as a JSON line to the events log and echoes it."""
+    line = json.dumps(event, sort_keys=True)
+    if events_path:
+        events_dir = os.path.dirname(events_path)
+        if events_dir and not os.path.isdir(events_dir):
+            os.makedirs(events_dir)
+        with open(events_path, "a") as fp:
+            fp.write(line + "\n")
+    print(line)
+    sys.stdout.flush()
+
+
+def run_hook(hook):
+    """Runs the checkpoint hook in a shell and returns its exit code."""
+    if not hook:
+        return None
+    return subprocess.call(hook, shell=True)
+
+
+def watch(client, hook=None, events_path=EVENTS_PATH, interval=5.0):
+    """Polls for a spot interruption notice and runs the hook when it comes.
+
+    Returns the instance action that triggered the hook.
+    """
+    try:
+        instance_id = client.get("instance-id")
+    except (URLError, socket.error):
+        instance_id = None
+    report({
+        "event": "started",
+        "instance_id": instance_id,
+        "time": time.time(),
+    }, events_path)
+
+    while True:
+        try:
+            action = client.instance_action()
+        except (HTTPError, URLError, socket.error, ValueError):
+            action = None
+        if action is not None:
+            break
+        time.sleep(interval)
+
+    report({
+        "event": "interruption",
+        "instance_id": instance_id,
+        "action": action.get("action"),
+        "action_time": action.get("time"),
+        "time": time.time(),
+    }, events_path)
+    start_time = time.time()
+    exit_code = run_hook(hook)
+    report({
+        "event": "checkpoint",
+        "instance_id": instance_id,
+        "exit_code": exit_code,
+        "duration": time.time() - start_time,
+        "time": time.time(),
+    }, events_path)
+    return action
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="ec2-agent",
+        description="Watch for spot interruption notices.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--hook", default=None,
+                        help="shell command to run on interruption notice")
+    parser.add_argument("--events_path", default=EVENTS_PATH,
+                        help="path to the events log")
+    parser.add_argument("--interval", type=float, default=5.0,
+                        help="polling interval in seconds")
+    parser.add_argument("--metadata_url", default=METADATA_URL,
+                        help="base URL of the instance metadata service")
+    args = parser.parse_args(argv)
+
+    client = MetadataClient(args.metadata_url)
+    watch(client, hook=args.hook, events_path=args.events_path,
+          interval=args.interval)
+
+
+if __name__ == "__main__":
+    main()
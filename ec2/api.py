@@ -0,0 +1,643 @@
+"""
+In-process Python API.
+
+Most commands of the command line interface use the API for the project
+operations. It can be used directly to avoid spawning `ec2` processes and
+parsing their output:
+
+    from ec2.api import Project
+
+    project = Project('/path/to/project')
+    for instance in project.instances():
+        print(instance.id, instance.public_dns_name)
+
+The methods return records (named tuples) or iterators of records and raise
+`ec2.exceptions.Ec2Error` subclasses on failure. AWS clients are shared by all
+projects of the process.
+"""
+from __future__ import absolute_import
+
+import collections
+import datetime
+import os
+import time
+
+from . import throttle
+from . import utils
+from .exceptions import ConfigError, ResourceError
+
+
+# Tags of the baked AMIs
+IMAGE_NAME_TAG = 'ec2:image-name'
+CONTENT_HASH_TAG = 'ec2:content-hash'
+
+# Tags of the project snapshots
+PROJECT_TAG = 'ec2:project'
+VOLUME_TAG = 'ec2:volume-id'
+BATCH_TAG = 'ec2:batch'
+EXPIRES_TAG = 'ec2:expires'
+SOURCE_SNAPSHOT_TAG = 'ec2:source-snapshot-id'
+
+# The device of the data volumes (see `misc/mount-data`)
+DATA_DEVICE = '/dev/xvdf'
+
+_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def _tag_list(tags):
+    return [{'Key': k, 'Value': v} for k, v in sorted(tags.items())]
+
+
+class Instance(collections.namedtuple('Instance', [
+        'id', 'type', 'state', 'availability_zone', 'public_dns_name',
+        'public_ip_address', 'spot_instance_request_id'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, instance):
+        return cls(
+            id=instance['InstanceId'],
+            type=instance['InstanceType'],
+            state=instance['State']['Name'],
+            availability_zone=instance['Placement']['AvailabilityZone'],
+            public_dns_name=instance.get('PublicDnsName'),
+            public_ip_address=instance.get('PublicIpAddress'),
+            spot_instance_request_id=instance.get('SpotInstanceRequestId'))
+
+
+class Image(collections.namedtuple('Image', [
+        'id', 'name', 'description', 'type', 'creation_date', 'state'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, image):
+        return cls(
+            id=image['ImageId'],
+            name=image.get('Name'),
+            description=image.get('Description'),
+            type=image['ImageType'],
+            creation_date=image['CreationDate'],
+            state=image['State'])
+
+
+class Snapshot(collections.namedtuple('Snapshot', [
+        'id', 'description', 'volume_id', 'state', 'progress',
+        'start_time', 'tags'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, snapshot):
+        return cls(
+            id=snapshot['SnapshotId'],
+            description=snapshot.get('Description'),
+            volume_id=snapshot['VolumeId'],
+            state=snapshot['State'],
+            progress=snapshot.get('Progress'),
+            start_time=snapshot['StartTime'],
+            tags=dict((tag['Key'], tag['Value'])
+                      for tag in snapshot.get('Tags', [])))
+
+
+class FileSystem(collections.namedtuple('FileSystem', [
+        'id', 'creation_token', 'creation_time', 'lifecycle_state',
+        'num_mount_targets'])):
+    __slots__ = ()
+
+    @classmethod
+    def from_response(cls, efs):
+        return cls(
+            id=efs['FileSystemId'],
+            creation_token=efs['CreationToken'],
+            creation_time=efs['CreationTime'],
+            lifecycle_state=efs['LifeCycleState'],
+            num_mount_targets=efs['NumberOfMountTargets'])
+
+
+SpotPrice = collections.namedtuple('SpotPrice', [
+    'availability_zone', 'instance_type', 'timestamp', 'price'])
+
+
+def find_images(client, name, content_hash=None):
+    """Return available baked AMIs sorted by creation date."""
+    filters = [
+        {
+            'Name': 'tag:' + IMAGE_NAME_TAG,
+            'Values': [name],
+        },
+        {
+            'Name': 'state',
+            'Values': ['available'],
+        },
+    ]
+    if content_hash is not None:
+        filters.append({
+            'Name': 'tag:' + CONTENT_HASH_TAG,
+            'Values': [content_hash],
+        })
+    paginator = client.get_paginator('describe_images')
+    images = [
+        image
+        for page in paginator.paginate(Owners=['self'], Filters=filters)
+        for image in page['Images']
+    ]
+    return sorted(images, key=lambda ami: ami['CreationDate'])
+
+
+class Project(object):
+    """An ec2 project bound to a config directory."""
+
+    def __init__(self, config_dir='.'):
+        self.config_dir = os.path.abspath(config_dir)
+        self._config = None
+
+    @property
+    def name(self):
+        return os.path.basename(self.config_dir)
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config = utils.load_config(self.config_dir)
+        return self._config
+
+    def reload(self):
+        """Drop the cached config, so that it is re-read on next access."""
+        self._config = None
+
+    def save(self):
+        utils.save_config(self.config, self.config_dir)
+
+    @property
+    def region(self):
+        """AWS region of the project (None for the default region)."""
+        try:
+            return self.config['AWS'].get('region')
+        except ConfigError:
+            return None
+
+    @property
+    def ec2(self):
+        return throttle.client('ec2', region_name=self.region)
+
+    @property
+    def efs(self):
+        return throttle.client('efs', region_name=self.region)
+
+    # Configuration
+
+    def refresh(self):
+        """Refresh the config from the actual state of the resources."""
+        config = self.config
+
+        # Check on the spot fleet
+        if config['EC2']['spot_fleet'] is not None:
+            response = self.ec2.describe_spot_fleet_instances(
+                SpotFleetRequestId=config['EC2']['spot_fleet']['id'])
+            if not response['ActiveInstances']:
+                config['EC2']['spot_fleet'] = None
+            else:
+                config['EC2']['spot_fleet']['instances'] = \
+                    response['ActiveInstances']
+
+        # Check on the EFS
+        if config['EFS'] is not None:
+            response = self.efs.describe_file_systems(
+                FileSystemId=config['EFS']['id'])
+            if not response['FileSystems']:
+                config['EFS'] = None
+
+        self.save()
+        return config
+
+    # Resources
+
+    def images(self):
+        """Iterate over personal AMIs."""
+        paginator = self.ec2.get_paginator('describe_images')
+        for page in paginator.paginate(Owners=['self']):
+            for image in page['Images']:
+                yield Image.from_response(image)
+
+    def latest_image(self):
+        """Return the newest AMI baked for the project or None."""
+        name = self.config['EC2'].get('image_name')
+        if name is None:
+            return None
+        images = find_images(self.ec2, name)
+        return Image.from_response(images[-1]) if images else None
+
+    def instances(self, state='running', instance_type=None,
+                  instance_ids=None, project_only=True):
+        """Iterate over instances.
+
+        By default, iterate over the instances of the project's spot fleet.
+        """
+        filters = []
+        if state is not None:
+            filters.append({
+                'Name': 'instance-state-name',
+                'Values': [state],
+            })
+        if instance_type is not None:
+            filters.append({
+                'Name': 'instance-type',
+                'Values': [instance_type],
+            })
+        kwargs = {'Filters': filters}
+        if instance_ids is None and project_only:
+            instance_ids = self.fleet_instance_ids()
+        if instance_ids is not None:
+            if not instance_ids:
+                return
+            kwargs['InstanceIds'] = list(instance_ids)
+
+        paginator = self.ec2.get_paginator('describe_instances')
+        for page in paginator.paginate(**kwargs):
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    yield Instance.from_response(instance)
+
+    def snapshots(self):
+        """Iterate over personal snapshots."""
+        paginator = self.ec2.get_paginator('describe_snapshots')
+        for page in paginator.paginate(OwnerIds=['self']):
+            for snapshot in page['Snapshots']:
+                yield Snapshot.from_response(snapshot)
+
+    def file_systems(self):
+        """Iterate over elastic file systems."""
+        paginator = self.efs.get_paginator('describe_file_systems')
+        for page in paginator.paginate():
+            for efs in page['FileSystems']:
+                yield FileSystem.from_response(efs)
+
+    # Spot fleets
+
+    def spot_prices(self, instance_type, days=1, availability_zone=''):
+        """Iterate over spot prices of the last days sorted by time."""
+        start_datetime = \
+            datetime.datetime.utcnow() - datetime.timedelta(days=days)
+        paginator = self.ec2.get_paginator('describe_spot_price_history')
+        pages = paginator.paginate(
+            StartTime=start_datetime,
+            InstanceTypes=[instance_type],
+            AvailabilityZone=availability_zone,
+            ProductDescriptions=['Linux/UNIX'])
+        prices = [
+            SpotPrice(
+                availability_zone=price['AvailabilityZone'],
+                instance_type=price['InstanceType'],
+                timestamp=price['Timestamp'],
+                price=price['SpotPrice'])
+            for page in pages
+            for price in page['SpotPriceHistory']
+        ]
+        for price in sorted(prices, key=lambda p: p.timestamp):
+            yield price
+
+    def fleet_instance_ids(self):
+        """Return ids of the active instances of the project's spot fleet."""
+        if self.config['EC2']['spot_fleet'] is None:
+            return []
+        response = self.ec2.describe_spot_fleet_instances(
+            SpotFleetRequestId=self.config['EC2']['spot_fleet']['id'])
+        return [
+            instance['InstanceId'] for instance in response['ActiveInstances']
+        ]
+
+    def request_fleet(self, image_id=None, instance_type='p2.xlarge',
+                      target_capacity=1, spot_price='0.9', valid_days=30,
+                      availability_zone='us-east-1a'):
+        """Request a new fleet of spot instances and return its id.
+
+        If no AMI is given, the newest AMI baked for the project is used.
+        """
+        config = self.config
+
+        if config['EC2']['spot_fleet'] is not None:
+            raise ResourceError(
+                "According to the current config, there already exists "
+                "an active spot fleet request: {spot_fleet_id}. "
+                "Before requesting a new spot fleet please cancel the "
+                "existing one to avoid resource leaks."
+                .format(spot_fleet_id=config['EC2']['spot_fleet']['id']))
+
+        if image_id is None:
+            image = self.latest_image()
+            if image is None:
+                raise ResourceError(
+                    "No AMI was baked for this project. "
+                    "Please specify the AMI id explicitly.")
+            image_id = image.id
+
+        # Resolve ValidUntil date
+        valid_from = datetime.datetime.utcnow()
+        valid_until = valid_from + datetime.timedelta(days=valid_days)
+        year, month, day = valid_until.year, valid_until.month, valid_until.day
+        valid_until = datetime.datetime(year, month, day)
+
+        request_config = {
+            'IamFleetRole': config['AWS']['iam_fleet_role_arn'],
+            'SpotPrice': spot_price,
+            'TargetCapacity': int(target_capacity),
+            'ValidUntil': valid_until,
+            'TerminateInstancesWithExpiration': True,
+            'LaunchSpecifications': [
+                {
+                    'ImageId': image_id,
+                    'InstanceType': instance_type,
+                    'KeyName': config['AWS']['key_name'],
+                    'Placement': {
+                        'AvailabilityZone': availability_zone,
+                    },
+                },
+            ],
+            'AllocationStrategy': 'lowestPrice',
+            'Type': 'request',
+        }
+
+        response = self.ec2.request_spot_fleet(
+            SpotFleetRequestConfig=request_config)
+        config['EC2']['spot_fleet'] = {
+            'id': response['SpotFleetRequestId'],
+            'instances': [],
+        }
+        self.save()
+        return response['SpotFleetRequestId']
+
+    def cancel_fleet(self):
+        """Cancel the fleet of spot instances and return its id."""
+        config = self.config
+
+        if config['EC2']['spot_fleet'] is None:
+            raise ResourceError(
+                "No active spot fleet requests. Nothing to cancel.")
+
+        spot_fleet_id = config['EC2']['spot_fleet']['id']
+        self.ec2.cancel_spot_fleet_requests(
+            SpotFleetRequestIds=[spot_fleet_id],
+            TerminateInstances=True)
+
+        config['EC2']['spot_fleet'] = None
+        self.save()
+        return spot_fleet_id
+
+    # Snapshots
+
+    def _describe_snapshots(self, client, **kwargs):
+        paginator = client.get_paginator('describe_snapshots')
+        for page in paginator.paginate(OwnerIds=['self'], **kwargs):
+            for snapshot in page['Snapshots']:
+                yield Snapshot.from_response(snapshot)
+
+    def project_snapshots(self, region=None):
+        """Iterate over snapshots taken by the project in the region."""
+        client = throttle.client('ec2', region_name=region or self.region)
+        return self._describe_snapshots(client, Filters=[
+            {
+                'Name': 'tag:' + PROJECT_TAG,
+                'Values': [self.name],
+            },
+        ])
+
+    def latest_snapshots(self):
+        """Return the snapshots of the latest batch taken by the project."""
+        snapshots = list(self.project_snapshots())
+        if not snapshots:
+            return []
+        batch = max(snapshot.tags.get(BATCH_TAG, '') for snapshot in snapshots)
+        return [s for s in snapshots if s.tags.get(BATCH_TAG, '') == batch]
+
+    def volumes(self, device=DATA_DEVICE):
+        """Return ids of the volumes attached to the spot fleet's instances."""
+        instance_ids = self.fleet_instance_ids()
+        if not instance_ids:
+            return []
+        paginator = self.ec2.get_paginator('describe_volumes')
+        pages = paginator.paginate(Filters=[
+            {
+                'Name': 'attachment.instance-id',
+                'Values': instance_ids,
+            },
+            {
+                'Name': 'attachment.device',
+                'Values': [device],
+            },
+        ])
+        return [volume['VolumeId']
+                for page in pages for volume in page['Volumes']]
+
+    def create_snapshots(self, device=DATA_DEVICE, retention_days=None,
+                         max_concurrency=16):
+        """Snapshot the data volumes of the spot fleet concurrently.
+
+        The snapshots are tagged with the project name, the batch (creation
+        time), and, if the retention period is given, the expiration time.
+        """
+        volume_ids = self.volumes(device)
+        if not volume_ids:
+            raise ResourceError(
+                "No volumes are attached to the spot fleet's instances "
+                "as {}.".format(device))
+
+        now = datetime.datetime.utcnow()
+        tags = {
+            PROJECT_TAG: self.name,
+            BATCH_TAG: now.strftime(_TIME_FORMAT),
+        }
+        if retention_days is not None:
+            expires = now + datetime.timedelta(days=retention_days)
+            tags[EXPIRES_TAG] = expires.strftime(_TIME_FORMAT)
+
+        client = self.ec2
+
+        def create_snapshot(volume_id):
+            response = client.create_snapshot(
+                VolumeId=volume_id,
+                Description="{} data ({})".format(self.name, volume_id),
+                TagSpecifications=[
+                    {
+                        'ResourceType': 'snapshot',
+                        'Tags': _tag_list(dict(tags, **{
+                            VOLUME_TAG: volume_id,
+                        })),
+                    },
+                ])
+            return Snapshot.from_response(response)
+
+        return utils.parallel_map(
+            create_snapshot, volume_ids, max_workers=max_concurrency)
+
+    def wait_for_snapshots(self, snapshot_ids, region=None, callback=None,
+                           sleep_time=10.0):
+        """Wait until the snapshots are completed and return them.
+
+        Each poll is a single batched `describe_snapshots` call; the callback
+        is called with the list of polled snapshots.
+        """
+        if not snapshot_ids:
+            return []
+        client = throttle.client('ec2', region_name=region or self.region)
+        while True:
+            snapshots = list(self._describe_snapshots(
+                client, SnapshotIds=list(snapshot_ids)))
+            if callback is not None:
+                callback(snapshots)
+            if all(snapshot.state != 'pending' for snapshot in snapshots):
+                return snapshots
+            time.sleep(sleep_time)
+
+    def copy_snapshots(self, snapshot_ids, regions, max_concurrency=4):
+        """Copy the snapshots to the regions in parallel.
+
+        Snapshots that were already copied to a region are skipped. Return
+        a list of `(region, source snapshot id, copy id)` tuples. Only
+        completed snapshots can be copied (see `wait_for_snapshots`).
+        """
+        source_region = self.ec2.meta.region_name
+        if not snapshot_ids:
+            return []
+        snapshots = list(self._describe_snapshots(
+            self.ec2, SnapshotIds=list(snapshot_ids)))
+        incomplete = [
+            "{} ({})".format(snapshot.id, snapshot.state)
+            for snapshot in snapshots if snapshot.state != 'completed'
+        ]
+        if incomplete:
+            raise ResourceError(
+                "Snapshots are not completed: {}.".format(
+                    ", ".join(incomplete)))
+
+        jobs = []
+        clients = {}
+        for region in regions:
+            clients[region] = throttle.client('ec2', region_name=region)
+            copied = dict(
+                (copy.tags[SOURCE_SNAPSHOT_TAG], copy.id)
+                for copy in self._describe_snapshots(clients[region], Filters=[
+                    {
+                        'Name': 'tag:' + SOURCE_SNAPSHOT_TAG,
+                        'Values': [snapshot.id for snapshot in snapshots],
+                    },
+                ]))
+            for snapshot in snapshots:
+                jobs.append((region, snapshot, copied.get(snapshot.id)))
+
+        def copy_snapshot(job):
+            region, snapshot, copy_id = job
+            if copy_id is None:
+                client = clients[region]
+                response = client.copy_snapshot(
+                    SourceRegion=source_region,
+                    SourceSnapshotId=snapshot.id,
+                    Description=snapshot.description or '')
+                copy_id = response['SnapshotId']
+                client.create_tags(
+                    Resources=[copy_id],
+                    Tags=_tag_list(dict(snapshot.tags, **{
+                        SOURCE_SNAPSHOT_TAG: snapshot.id,
+                    })))
+            return region, snapshot.id, copy_id
+
+        return utils.parallel_map(
+            copy_snapshot, jobs, max_workers=max_concurrency)
+
+    def prune_snapshots(self, keep=1, region=None, dry_run=False,
+                        max_concurrency=8):
+        """Delete the expired snapshots of the project.
+
+        Only snapshots with the expiration tag are deleted, and the newest
+        `keep` snapshots of each volume are always kept. Return the deleted
+        snapshots and a list of `(snapshot, error)` tuples of the snapshots
+        that failed to be deleted (e.g., are in use by an AMI).
+        """
+        now = datetime.datetime.utcnow().strftime(_TIME_FORMAT)
+        snapshots_per_volume = {}
+        for snapshot in self.project_snapshots(region):
+            volume_id = snapshot.tags.get(VOLUME_TAG, snapshot.volume_id)
+            snapshots_per_volume.setdefault(volume_id, []).append(snapshot)
+
+        expired = []
+        for snapshots in snapshots_per_volume.values():
+            snapshots.sort(key=lambda s: s.start_time, reverse=True)
+            for snapshot in snapshots[keep:]:
+                expires = snapshot.tags.get(EXPIRES_TAG)
+                if snapshot.state == 'completed' and \
+                        expires is not None and expires <= now:
+                    expired.append(snapshot)
+
+        if dry_run:
+            return expired, []
+        client = throttle.client('ec2', region_name=region or self.region)
+
+        def delete_snapshot(snapshot):
+            try:
+                client.delete_snapshot(SnapshotId=snapshot.id)
+            except Exception as e:
+                return e
+            return None
+
+        # EC2 has no batch delete: deletions share the rate limiter
+        errors = utils.parallel_map(
+            delete_snapshot, expired, max_workers=max_concurrency)
+        deleted = [s for s, e in zip(expired, errors) if e is None]
+        failed = [(s, e) for s, e in zip(expired, errors) if e is not None]
+        return deleted, failed
+
+    # SSH
+
+    def ssh_params(self, instance_ids):
+        """Return SSH user, hosts, and key filename of running instances."""
+        hosts = []
+        if instance_ids:
+            hosts = [
+                instance.public_dns_name
+                for instance in self.instances(instance_ids=instance_ids)
+            ]
+        user = 'ubuntu'
+        key_filename = os.path.join(
+            os.path.expandvars("$HOME/.ssh"),
+            "{}.pem".format(self.config['AWS']['key_name'].lower()))
+        return user, hosts, key_filename
+
+    # EFS
+
+    def _efs_hosts(self, instance_ids, spot_fleet):
+        if self.config['EFS'] is None:
+            raise ResourceError("No EFS is associated with this project.")
+        instance_ids = list(instance_ids)
+        if spot_fleet:
+            instance_ids += self.fleet_instance_ids()
+        user, hosts, key_filename = self.ssh_params(instance_ids)
+        if not hosts:
+            raise ResourceError(
+                "No running instances is available for the given request.")
+        return user, hosts, key_filename
+
+    def mount_efs(self, instance_ids=(), spot_fleet=False):
+        """Mount the EFS to the instances; return outputs per host."""
+        user, hosts, key_filename = self._efs_hosts(instance_ids, spot_fleet)
+
+        # Construct EFS mount command
+        efs_dns_name = "{efs_id}.efs.{aws_region}.amazonaws.com".format(
+            efs_id=self.config['EFS']['id'],
+            aws_region=self.config['AWS']['region'])
+        mount_cmd = \
+            "mount -t nfs4 " \
+            "-o nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600," \
+            "retrans=2 " \
+            "{efs_dns_name}:/ {efs_mount_point}".format(
+                efs_dns_name=efs_dns_name,
+                efs_mount_point=self.config['EFS']['token'])
+
+        return utils.ssh_run(mount_cmd, user, hosts, key_filename)
+
+    def umount_efs(self, instance_ids=(), spot_fleet=False):
+        """Unmount the EFS from the instances; return outputs per host."""
+        user, hosts, key_filename = self._efs_hosts(instance_ids, spot_fleet)
+
+        # Construct EFS unmount command
+        umount_cmd = "umount {efs_mount_point}".format(
+            efs_mount_point=self.config['EFS']['token'])
+
+        return utils.ssh_run(umount_cmd, user, hosts, key_filename)
@@ -9,7 +9,7 @@ import os
 from . import commands as cmd
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = argparse.ArgumentParser(
         prog="ec2",
         description="A minimalistic CLI to handle AWS EC2 projects.",
@@ -29,7 +29,7 @@ def parse_args():
         "configure",
         description="Configure ec2 for the current project.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    configure.set_defaults(cmd=cmd.configure)
+    configure.set_defaults(cmd=cmd.configure, local=True)
     configure.add_argument("-k", "--key_name", default="default",
                            help="the name of the secrete key to use with ec2")
     configure.add_argument("-r", "--region", default="us-east-1",
@@ -44,6 +44,21 @@ def parse_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     refresh.set_defaults(cmd=cmd.refresh)
 
+    status = commands.add_parser(
+        "status",
+        description="Show and refresh status of many projects at once.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    status.set_defaults(cmd=cmd.status)
+    status.add_argument(
+        "roots", nargs="*", default=["."],
+        help="directories where to look for ec2 projects")
+    status.add_argument(
+        "--max_depth", type=int, default=3,
+        help="how deep to look for ec2 projects under the roots")
+    status.add_argument(
+        "--dry_run", action="store_true",
+        help="whether to show the status without updating the configs.")
+
     # Listing resources (AMIs, instances, snapshots, EFSs)
     list_resources = commands.add_parser(
         "list",
@@ -84,6 +99,113 @@ def parse_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     list_snapshots.set_defaults(cmd=cmd.list_snapshots)
 
+    # AMIs
+    image = commands.add_parser(
+        "image",
+        description="Operations with AMIs.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    image_subparsers = image.add_subparsers(title="image commands")
+
+    image_bake = image_subparsers.add_parser(
+        "bake",
+        description="Bake an AMI from a provisioned instance.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    image_bake.set_defaults(cmd=cmd.bake_image, local=True)
+    image_bake.add_argument(
+        "-n", "--name", default=None,
+        help="name of the image (defaults to the project directory name)")
+    image_bake.add_argument(
+        "-i", "--instance_id", default=None,
+        help="running instance to bake the AMI from")
+    image_bake.add_argument(
+        "--spot_fleet", action="store_true",
+        help="whether to bake the AMI from a spot fleet's instance.")
+    image_bake.add_argument(
+        "-ami", "--base_image", default=None,
+        help="base AMI to launch a new instance from")
+    image_bake.add_argument(
+        "-s", "--script", default=None,
+        help="provisioning script to run on the instance before baking")
+    image_bake.add_argument(
+        "--inputs", nargs="+", default=[],
+        help="other provisioning inputs to include into the content hash")
+    image_bake.add_argument(
+        "-t", "--instance_type", metavar="TYPE", default="t2.medium",
+        help="type of the instance launched from the base AMI")
+    image_bake.add_argument(
+        "-z", "--availability_zone", metavar="ZONE", default="us-east-1a",
+        help="availability zone of the instance launched from the base AMI")
+    image_bake.add_argument(
+        "--copy_to_regions", nargs="+", default=[],
+        help="regions where to copy the baked AMI.")
+    image_bake.add_argument(
+        "--no_reboot", action="store_true",
+        help="whether to bake the AMI without rebooting the instance.")
+    image_bake.add_argument(
+        "-f", "--force", action="store_true",
+        help="whether to rebuild the AMI even if the inputs are unchanged.")
+
+    # Snapshots
+    snapshot = commands.add_parser(
+        "snapshot",
+        description="Operations with snapshots of the data volumes.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    snapshot_subparsers = snapshot.add_subparsers(title="snapshot commands")
+
+    snapshot_create = snapshot_subparsers.add_parser(
+        "create",
+        description="Snapshot the data volumes of the spot fleet.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    snapshot_create.set_defaults(cmd=cmd.create_snapshots, local=True)
+    snapshot_create.add_argument(
+        "-d", "--device", default="/dev/xvdf",
+        help="device of the data volumes")
+    snapshot_create.add_argument(
+        "-r", "--retention_days", type=float, default=None,
+        help="after how many days the snapshots can be pruned")
+    snapshot_create.add_argument(
+        "--max_concurrency", type=int, default=16,
+        help="maximum number of concurrent snapshot requests")
+    snapshot_create.add_argument(
+        "--no_wait", action="store_true",
+        help="whether to return without waiting on the snapshots.")
+
+    snapshot_copy = snapshot_subparsers.add_parser(
+        "copy",
+        description="Copy snapshots to other regions.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    snapshot_copy.set_defaults(cmd=cmd.copy_snapshots, local=True)
+    snapshot_copy.add_argument(
+        "--regions", nargs="+", required=True,
+        help="regions where to copy the snapshots")
+    snapshot_copy.add_argument(
+        "-s", "--snapshot_ids", nargs="+", default=[],
+        help="snapshots to copy (defaults to the latest project snapshots)")
+    snapshot_copy.add_argument(
+        "--max_concurrency", type=int, default=4,
+        help="maximum number of concurrent copy requests")
+    snapshot_copy.add_argument(
+        "--no_wait", action="store_true",
+        help="whether to return without waiting on the copies.")
+
+    snapshot_prune = snapshot_subparsers.add_parser(
+        "prune",
+        description="Delete expired snapshots of the project.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    snapshot_prune.set_defaults(cmd=cmd.prune_snapshots)
+    snapshot_prune.add_argument(
+        "-k", "--keep", type=int, default=1,
+        help="number of the newest snapshots per volume to always keep")
+    snapshot_prune.add_argument(
+        "--regions", nargs="+", default=[],
+        help="other regions where to prune the snapshot copies")
+    snapshot_prune.add_argument(
+        "--max_concurrency", type=int, default=8,
+        help="maximum number of concurrent delete requests")
+    snapshot_prune.add_argument(
+        "--dry_run", action="store_true",
+        help="whether to only list the expired snapshots.")
+
     # Spot fleets
     fleet = commands.add_parser(
         "fleet",
@@ -114,7 +236,8 @@ def parse_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     spot_fleet_request.set_defaults(cmd=cmd.request_spot_fleet)
     spot_fleet_request.add_argument(
-        "-ami", "--image_id", required=True, help="AMI image id")
+        "-ami", "--image_id", default=None,
+        help="AMI image id (defaults to the newest AMI baked for the project)")
     spot_fleet_request.add_argument(
         "-t", "--instance_type", metavar="TYPE", default="p2.xlarge",
         help="type of the requested instances")
@@ -137,6 +260,62 @@ def parse_args():
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     spot_fleet_cancel.set_defaults(cmd=cmd.cancel_spot_fleet)
 
+    spot_fleet_agent = fleet_subparsers.add_parser(
+        "agent",
+        description="Install the spot interruption agent on instances.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    spot_fleet_agent.set_defaults(cmd=cmd.install_agent)
+    spot_fleet_agent.add_argument(
+        "-i", "--instances", nargs="+", default=[],
+        help="list of instances to install the agent on.")
+    spot_fleet_agent.add_argument(
+        "--spot_fleet", action="store_true",
+        help="whether to install the agent on the spot fleet's instances.")
+    spot_fleet_agent.add_argument(
+        "--hook", default="sync",
+        help="checkpoint command to run on a spot interruption notice.")
+    spot_fleet_agent.add_argument(
+        "--interval", type=float, default=5.0,
+        help="how often (in seconds) the agent polls instance metadata.")
+
+    spot_fleet_watch = fleet_subparsers.add_parser(
+        "watch",
+        description="Stream events reported by the spot fleet agents.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    spot_fleet_watch.set_defaults(cmd=cmd.watch_fleet, local=True)
+    spot_fleet_watch.add_argument(
+        "--interval", type=float, default=10.0,
+        help="how often (in seconds) to poll the instances for events.")
+
+    spot_fleet_stats = fleet_subparsers.add_parser(
+        "stats",
+        description="Sample resource utilization of the spot fleet instances.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    spot_fleet_stats.set_defaults(cmd=cmd.fleet_stats)
+    spot_fleet_stats.add_argument(
+        "-w", "--watch", type=float, metavar="SECONDS", default=None,
+        help="keep sampling every given number of seconds.")
+    spot_fleet_stats.add_argument(
+        "--sample_interval", type=float, default=1.0,
+        help="time window (in seconds) over which rates are measured.")
+    spot_fleet_stats.add_argument(
+        "--idle_minutes", type=float, default=30.,
+        help="flag instances that have been idle for this many minutes.")
+    spot_fleet_stats.add_argument(
+        "--cpu_threshold", type=float, default=5.,
+        help="CPU utilization (%%) below which an instance is idle.")
+    spot_fleet_stats.add_argument(
+        "--gpu_threshold", type=float, default=5.,
+        help="GPU utilization (%%) below which an instance is idle.")
+    spot_fleet_stats.add_argument(
+        "--disk_threshold", type=float, default=1.,
+        help="disk throughput (MB/s, read + write) below which an instance "
+             "is idle.")
+    spot_fleet_stats.add_argument(
+        "--net_threshold", type=float, default=1.,
+        help="network throughput (MB/s, received + sent) below which an "
+             "instance is idle.")
+
     # EFS
     efs = commands.add_parser(
         "efs",
@@ -148,7 +327,7 @@ def parse_args():
         "create",
         description="Create an EFS.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    efs_create.set_defaults(cmd=cmd.create_efs)
+    efs_create.set_defaults(cmd=cmd.create_efs, local=True)
     efs_create.add_argument(
         "--creation_token", default="data",
         help="Creation token: string of up to 64 ASCII characters.")
@@ -170,7 +349,7 @@ def parse_args():
         "delete",
         description="Delete an EFS.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    efs_delete.set_defaults(cmd=cmd.delete_efs)
+    efs_delete.set_defaults(cmd=cmd.delete_efs, local=True)
 
     efs_mount = efs_subparsers.add_parser(
         "mount",
@@ -196,8 +375,36 @@ def parse_args():
         "--spot_fleet", action="store_true",
         help="whether to try to unmount EFS to the spot fleet's instances.")
 
+    # Daemon
+    daemon = commands.add_parser(
+        "daemon",
+        description="Manage the background daemon that serves ec2 commands.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    daemon_subparsers = daemon.add_subparsers(title="daemon commands")
+
+    daemon_start = daemon_subparsers.add_parser(
+        "start",
+        description="Start the daemon.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    daemon_start.set_defaults(cmd=cmd.start_daemon, local=True)
+    daemon_start.add_argument(
+        "--cache_ttl", type=float, default=5.0,
+        help="how long (in seconds) to cache AWS API responses.")
+
+    daemon_stop = daemon_subparsers.add_parser(
+        "stop",
+        description="Stop the daemon.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    daemon_stop.set_defaults(cmd=cmd.stop_daemon, local=True)
+
+    daemon_status = daemon_subparsers.add_parser(
+        "status",
+        description="Check whether the daemon is running.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    daemon_status.set_defaults(cmd=cmd.daemon_status, local=True)
+
     # Parse and post-process args
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     args.config_dir = os.path.abspath(args.config_dir)
 
     return args
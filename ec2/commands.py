@@ -7,25 +7,27 @@ from __future__ import absolute_import, print_function
 
 import os
 import sys
+import time
 import yaml
 import datetime
 
-import boto3
+import six
 
 from pprint import pprint
+from six.moves import shlex_quote
 
+from . import agent
+from . import api
+from . import daemon
+from . import stats
+from . import throttle
 from . import utils
-
-
-# AWS service clients
-_EC2 = boto3.client('ec2')
-_IAM = boto3.client('iam')
-_EFS = boto3.client('efs')
+from .exceptions import ResourceError
 
 
 def show(args):
     """Show configuration of the current project."""
-    config = utils.load_config(args.config_dir)
+    config = api.Project(args.config_dir).config
     print(yaml.dump(config, default_flow_style=False))
 
 
@@ -54,7 +56,8 @@ def configure(args):
     config['AWS']['region'] = args.region
 
     # IAM fleet role name
-    response = _IAM.get_role(RoleName=args.iam_fleet_role_name)
+    response = throttle.client('iam').get_role(
+        RoleName=args.iam_fleet_role_name)
     iam_fleet_role_arn = response['Role']['Arn']
     config['AWS']['iam_fleet_role_arn'] = iam_fleet_role_arn
 
@@ -69,228 +72,711 @@ def configure(args):
 def refresh(args):
     """Refresh config of the current project."""
     print("Refreshing config for '{}'...".format(args.config_dir))
-    config = utils.load_config(args.config_dir)
-
-    # Check on the spot fleet
-    if config['EC2']['spot_fleet'] is not None:
-        response = _EC2.describe_spot_fleet_instances(
-            SpotFleetRequestId=config['EC2']['spot_fleet']['id'])
-        if not response['ActiveInstances']:
-            config['EC2']['spot_fleet'] = None
-        else:
-            config['EC2']['spot_fleet']['instances'] = \
-                response['ActiveInstances']
-
-    # Check on the EFS
-    if config['EFS'] is not None:
-        response = _EFS.describe_file_systems(
-            FileSystemId=config['EFS']['id'])
-        if not response['FileSystems']:
-            config['EFS'] = None
-
-    utils.save_config(config, args.config_dir)
+    api.Project(args.config_dir).refresh()
     print("Done.")
 
 
+def _describe_region(region, fleet_ids, efs_ids):
+    """Describe spot fleets, their instances and EFSs of the region.
+
+    Use as few (paginated) API calls as possible regardless of the number of
+    projects: the spot fleets, the instances of all the fleets, the EFSs, and
+    the spot prices of all the running instance types are described at once.
+    """
+    ec2_client = throttle.client('ec2', region_name=region)
+    efs_client = throttle.client('efs', region_name=region)
+
+    fleets = {}
+    if fleet_ids:
+        paginator = ec2_client.get_paginator('describe_spot_fleet_requests')
+        for page in paginator.paginate():
+            for fleet in page['SpotFleetRequestConfigs']:
+                if fleet['SpotFleetRequestId'] in fleet_ids:
+                    fleets[fleet['SpotFleetRequestId']] = fleet
+
+    instances = {}
+    active_fleet_ids = sorted(fleets)
+    # Filters accept up to 200 values
+    for i in range(0, len(active_fleet_ids), 200):
+        paginator = ec2_client.get_paginator('describe_instances')
+        pages = paginator.paginate(Filters=[
+            {
+                'Name': 'tag:aws:ec2spot:fleet-request-id',
+                'Values': active_fleet_ids[i:i + 200],
+            },
+            {
+                'Name': 'instance-state-name',
+                'Values': ['running'],
+            },
+        ])
+        for page in pages:
+            for reservation in page['Reservations']:
+                for instance in reservation['Instances']:
+                    tags = {t['Key']: t['Value']
+                            for t in instance.get('Tags', [])}
+                    fleet_id = tags['aws:ec2spot:fleet-request-id']
+                    instances.setdefault(fleet_id, []).append(instance)
+
+    file_systems = {}
+    if efs_ids:
+        paginator = efs_client.get_paginator('describe_file_systems')
+        for page in paginator.paginate():
+            for efs in page['FileSystems']:
+                if efs['FileSystemId'] in efs_ids:
+                    file_systems[efs['FileSystemId']] = efs
+
+    prices = {}
+    instance_types = sorted(set(
+        instance['InstanceType']
+        for fleet_instances in instances.values()
+        for instance in fleet_instances
+    ))
+    if instance_types:
+        paginator = ec2_client.get_paginator('describe_spot_price_history')
+        pages = paginator.paginate(
+            StartTime=datetime.datetime.utcnow(),
+            InstanceTypes=instance_types,
+            ProductDescriptions=['Linux/UNIX'])
+        for page in pages:
+            for price in page['SpotPriceHistory']:
+                key = (price['InstanceType'], price['AvailabilityZone'])
+                if key not in prices or prices[key][0] < price['Timestamp']:
+                    prices[key] = (price['Timestamp'],
+                                   float(price['SpotPrice']))
+
+    return fleets, instances, file_systems, prices
+
+
+def status(args):
+    """Show and refresh status of all projects under the given roots."""
+    config_dirs = utils.find_config_dirs(args.roots, max_depth=args.max_depth)
+    if not config_dirs:
+        print("No ec2 projects found.")
+        return
+    configs = dict(
+        (config_dir, utils.load_config(config_dir))
+        for config_dir in config_dirs)
+
+    # Collect the referenced resources per region
+    resources = {}
+    for config in configs.values():
+        fleet_ids, efs_ids = resources.setdefault(
+            config['AWS']['region'], (set(), set()))
+        if config['EC2']['spot_fleet'] is not None:
+            fleet_ids.add(config['EC2']['spot_fleet']['id'])
+        if config['EFS'] is not None:
+            efs_ids.add(config['EFS']['id'])
+
+    regions = sorted(resources)
+    descriptions = dict(zip(regions, utils.parallel_map(
+        lambda region: _describe_region(region, *resources[region]),
+        regions)))
+
+    # Update the configs
+    rows = []
+    total_burn = 0.
+    for config_dir in config_dirs:
+        config = configs[config_dir]
+        fleets, instances, file_systems, prices = \
+            descriptions[config['AWS']['region']]
+
+        fleet_id, fleet_state, fleet_instances = None, '-', []
+        if config['EC2']['spot_fleet'] is not None:
+            fleet_id = config['EC2']['spot_fleet']['id']
+            fleet = fleets.get(fleet_id)
+            fleet_instances = instances.get(fleet_id, [])
+            if fleet is not None:
+                fleet_state = fleet['SpotFleetRequestState']
+            if not fleet_instances and \
+                    fleet_state not in ('submitted', 'active', 'modifying'):
+                config['EC2']['spot_fleet'] = None
+            else:
+                config['EC2']['spot_fleet']['instances'] = [
+                    {
+                        'InstanceId': instance['InstanceId'],
+                        'InstanceType': instance['InstanceType'],
+                        'SpotInstanceRequestId':
+                            instance.get('SpotInstanceRequestId'),
+                    }
+                    for instance in fleet_instances
+                ]
+
+        efs_id, efs_state = None, '-'
+        if config['EFS'] is not None:
+            efs_id = config['EFS']['id']
+            efs = file_systems.get(efs_id)
+            if efs is None:
+                config['EFS'] = None
+                efs_state = 'deleted'
+            else:
+                efs_state = efs['LifeCycleState']
+
+        burn = sum(
+            prices.get((instance['InstanceType'],
+                        instance['Placement']['AvailabilityZone']),
+                       (None, 0.))[1]
+            for instance in fleet_instances)
+        total_burn += burn
+        rows.append((
+            os.path.relpath(config_dir),
+            fleet_id or '-', fleet_state, len(fleet_instances),
+            efs_id or '-', efs_state, burn))
+
+    if not args.dry_run:
+        utils.parallel_map(
+            lambda config_dir: utils.save_config(
+                configs[config_dir], config_dir),
+            config_dirs)
+
+    row_format = "{:<32} {:<28} {:<12} {:>9} {:<22} {:<10} {:>8}"
+    print(row_format.format(
+        "PROJECT", "SPOT FLEET", "STATE", "INSTANCES", "EFS", "STATE",
+        "$/HOUR"))
+    for row in rows:
+        print(row_format.format(*(row[:-1] + ("{:.3f}".format(row[-1]),))))
+    print("Total: {} project(s), {} instance(s), ${:.3f}/hour.".format(
+        len(rows), sum(row[3] for row in rows), total_burn))
+
+
 def list_images(args):
     """List personal AMIs."""
-    response = _EC2.describe_images(Owners=['self'])
-
-    for ami in response['Images']:
+    for ami in api.Project(args.config_dir).images():
         print('-' * 80)
-        print('Name:', ami['Name'])
-        print('Description', ami['Description'])
-        print('ImageId:', ami['ImageId'])
-        print('ImageType:', ami['ImageType'])
-        print('CreationDate:', ami['CreationDate'])
-        print('State:', ami['State'])
+        print('Name:', ami.name)
+        print('Description', ami.description)
+        print('ImageId:', ami.id)
+        print('ImageType:', ami.type)
+        print('CreationDate:', ami.creation_date)
+        print('State:', ami.state)
         utils.STDOUT.flush()
     print('-' * 80)
 
 
 def list_instances(args):
     """List available instances."""
-    filters = []
-    if args.instance_state is not None:
-        filters.append({
-            'Name': 'instance-state-name',
-            'Values': [args.instance_state]
-        })
-    if args.instance_type is not None:
-        filters.append({
-            'Name': 'instance-type',
-            'Values': [args.instance_type]
-        })
     if not args.all:
         print("Instances used in the current project:")
-        config = utils.load_config(args.config_dir)
-        if config['EC2']['spot_fleet'] is not None:
-            response = _EC2.describe_spot_fleet_instances(
-                SpotFleetRequestId=config['EC2']['spot_fleet']['id'])
-            if not response['ActiveInstances']:
-                print("No instances are currently in use.")
-                return
-            spot_instance_request_id = \
-                response['ActiveInstances'][0]['SpotInstanceRequestId']
-            filters.append({
-                'Name': 'spot-instance-request-id',
-                'Values': [spot_instance_request_id],
-            })
-        else:
-            print("No instances are currently in use.")
-            return
     else:
         print("Available instances:")
 
-    response = _EC2.describe_instances(Filters=filters)
-    if not response['Reservations']:
+    instances = api.Project(args.config_dir).instances(
+        state=args.instance_state,
+        instance_type=args.instance_type,
+        project_only=not args.all)
+    num_instances = 0
+    for instance in instances:
+        num_instances += 1
+        print('-' * 80)
+        print('InstanceId:', instance.id)
+        print('InstanceType:', instance.type)
+        print('PublicDnsName:', instance.public_dns_name)
+        print('PublicIpAddress:', instance.public_ip_address)
+        utils.STDOUT.flush()
+    if not num_instances:
         print("No available instances.")
     else:
-        for reservation in response['Reservations']:
-            instance = reservation['Instances'][0]
-            print('-' * 80)
-            print('InstanceId:', instance['InstanceId'])
-            print('InstanceType:', instance['InstanceType'])
-            print('PublicDnsName:', instance['PublicDnsName'])
-            print('PublicIpAddress:', instance['PublicIpAddress'])
-            utils.STDOUT.flush()
         print('-' * 80)
 
 
 def list_snapshots(args):
     """List available snapshots."""
-    response = _EC2.describe_snapshots(OwnerIds=['self'])
-
-    if not response['Snapshots']:
+    num_snapshots = 0
+    for snapshot in api.Project(args.config_dir).snapshots():
+        num_snapshots += 1
+        print('-' * 80)
+        print('Description:', snapshot.description)
+        print('SnapshotId:', snapshot.id)
+        print('VolumeId:', snapshot.volume_id)
+        print('State:', snapshot.state)
+        utils.STDOUT.flush()
+    if not num_snapshots:
         print("No available snapshots.")
     else:
-        for snapshot in response['Snapshots']:
-            print('-' * 80)
-            print('Description:', snapshot['Description'])
-            print('SnapshotId:', snapshot['SnapshotId'])
-            print('VolumeId:', snapshot['VolumeId'])
-            print('State:', snapshot['State'])
-            utils.STDOUT.flush()
         print('-' * 80)
 
 
 def list_efs(args):
     """List available elastic file systems."""
-    response = _EFS.describe_file_systems()
-
-    if not response['FileSystems']:
+    num_file_systems = 0
+    for efs in api.Project(args.config_dir).file_systems():
+        num_file_systems += 1
+        print('-' * 80)
+        print('FileSystemId:', efs.id)
+        print('CreationTime:', efs.creation_time)
+        print('LifeCycleState:', efs.lifecycle_state)
+        print('NumberOfMountTargets:', efs.num_mount_targets)
+        utils.STDOUT.flush()
+    if not num_file_systems:
         print("No available EFS.")
     else:
-        for efs in response['FileSystems']:
-            print('-' * 80)
-            print('FileSystemId:', efs['FileSystemId'])
-            print('CreationTime:', efs['CreationTime'])
-            print('LifeCycleState:', efs['LifeCycleState'])
-            print('NumberOfMountTargets:', efs['NumberOfMountTargets'])
-            utils.STDOUT.flush()
         print('-' * 80)
 
 
+def _wait_for_image(client, image_id, show_progress=True, sleep_time=10.0):
+    """Wait until the AMI leaves the pending state and return it."""
+    # New AMIs (and copies) are not visible to `describe_images` right away
+    client.get_waiter('image_exists').wait(ImageIds=[image_id])
+    while True:
+        images = client.describe_images(ImageIds=[image_id])['Images']
+        if images and images[0]['State'] != 'pending':
+            break
+        progress = 0.
+        snapshot_ids = [
+            mapping['Ebs']['SnapshotId']
+            for mapping in (images[0]['BlockDeviceMappings'] if images else [])
+            if 'SnapshotId' in mapping.get('Ebs', {})
+        ]
+        if snapshot_ids:
+            response = client.describe_snapshots(SnapshotIds=snapshot_ids)
+            progress = sum(
+                float(snapshot['Progress'].rstrip('%') or 0)
+                for snapshot in response['Snapshots']
+            ) / len(snapshot_ids)
+        if show_progress:
+            print("\r...{} - pending ({:.0f}%)".format(image_id, progress),
+                  end="")
+            utils.STDOUT.flush()
+        time.sleep(sleep_time)
+    if show_progress:
+        print("\r...{} - {}.{}".format(image_id, images[0]['State'], ' ' * 8))
+    return images[0]
+
+
+def _launch_instance(project, args):
+    """Launch an on-demand instance from the base AMI."""
+    response = project.ec2.run_instances(
+        ImageId=args.base_image,
+        InstanceType=args.instance_type,
+        KeyName=project.config['AWS']['key_name'],
+        MinCount=1,
+        MaxCount=1,
+        Placement={
+            'AvailabilityZone': args.availability_zone,
+        })
+    return response['Instances'][0]['InstanceId']
+
+
+def _copy_image(client, image, name, content_hash, source_region):
+    """Copy the AMI to the client's region (unless it is already there)."""
+    region = client.meta.region_name
+    existing = api.find_images(client, name, content_hash)
+    if existing:
+        return region, existing[-1]['ImageId'], 'exists'
+    response = client.copy_image(
+        SourceImageId=image['ImageId'],
+        SourceRegion=source_region,
+        Name=image['Name'],
+        Description=image.get('Description', ''))
+    client.create_tags(
+        Resources=[response['ImageId']],
+        Tags=[
+            {'Key': api.IMAGE_NAME_TAG, 'Value': name},
+            {'Key': api.CONTENT_HASH_TAG, 'Value': content_hash},
+        ])
+    copy = _wait_for_image(client, response['ImageId'], show_progress=False)
+    return region, copy['ImageId'], copy['State']
+
+
+def bake_image(args):
+    """Bake an AMI from a provisioned instance."""
+    project = api.Project(args.config_dir)
+    name = args.name or project.name
+
+    instance_id = args.instance_id
+    if instance_id is None and args.spot_fleet:
+        instance_ids = project.fleet_instance_ids()
+        if not instance_ids:
+            print("No instances are currently in use.")
+            return
+        instance_id = instance_ids[0]
+    if instance_id is not None:
+        response = project.ec2.describe_instances(InstanceIds=[instance_id])
+        base_image = response['Reservations'][0]['Instances'][0]['ImageId']
+    elif args.base_image is not None:
+        base_image = args.base_image
+    else:
+        print("Please specify an instance to bake or a base AMI to launch.")
+        return
+
+    image_name = "{}-{}".format(
+        name, datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+
+    # Hash the provisioning inputs to skip unnecessary rebuilds
+    inputs = list(args.inputs)
+    if args.script is not None:
+        inputs.append(args.script)
+    extra = [base_image]
+    if instance_id is not None:
+        # The inputs do not capture the state of an existing instance, so
+        # its bakes are never skipped (nor are their copies)
+        extra += [instance_id, image_name]
+    content_hash = utils.content_hash(inputs, extra=extra)
+
+    existing = api.find_images(project.ec2, name, content_hash)
+    if existing and not args.force:
+        image = existing[-1]
+        print("AMI {} was baked from the same inputs. Skipping the rebuild."
+              .format(image['ImageId']))
+    else:
+        launched = instance_id is None
+        if launched:
+            instance_id = _launch_instance(project, args)
+        try:
+            if launched:
+                # Inside the try, so that the instance is terminated even if
+                # it fails to start
+                print("Launched instance {}. Waiting for it to run..."
+                      .format(instance_id))
+                utils.STDOUT.flush()
+                project.ec2.get_waiter('instance_running').wait(
+                    InstanceIds=[instance_id])
+            if args.script is not None:
+                print("Provisioning instance {}...".format(instance_id))
+                user, hosts, key_filename = project.ssh_params([instance_id])
+                # Freshly launched instances need time to start SSH
+                ssh_settings = {'connection_attempts': 30, 'timeout': 10}
+                utils.ssh_put(args.script, '/tmp/ec2-provision.sh',
+                              user, hosts, key_filename, **ssh_settings)
+                utils.ssh_run('bash /tmp/ec2-provision.sh',
+                              user, hosts, key_filename, **ssh_settings)
+
+            print("Creating AMI '{}' from instance {}..."
+                  .format(image_name, instance_id))
+            response = project.ec2.create_image(
+                InstanceId=instance_id,
+                Name=image_name,
+                Description="Baked by ec2 from {}".format(base_image),
+                NoReboot=args.no_reboot)
+            project.ec2.create_tags(
+                Resources=[response['ImageId']],
+                Tags=[
+                    {'Key': api.IMAGE_NAME_TAG, 'Value': name},
+                    {'Key': api.CONTENT_HASH_TAG, 'Value': content_hash},
+                ])
+            image = _wait_for_image(project.ec2, response['ImageId'])
+        finally:
+            if launched:
+                print("Terminating instance {}...".format(instance_id))
+                project.ec2.terminate_instances(InstanceIds=[instance_id])
+        if image['State'] != 'available':
+            raise ResourceError("AMI {} is in state '{}'.".format(
+                image['ImageId'], image['State']))
+
+    project.config['EC2']['image_name'] = name
+    project.save()
+
+    if args.copy_to_regions:
+        print("Copying AMI {} to {}...".format(
+            image['ImageId'], ", ".join(args.copy_to_regions)))
+        utils.STDOUT.flush()
+        clients = [
+            throttle.client('ec2', region_name=region)
+            for region in args.copy_to_regions
+        ]
+        source_region = project.ec2.meta.region_name
+        copies = utils.parallel_map(
+            lambda client: _copy_image(
+                client, image, name, content_hash, source_region),
+            clients)
+        for region, image_id, state in copies:
+            print("...in {} - {} ({}).".format(region, image_id, state))
+        failed = [
+            "{} in {}".format(image_id, region)
+            for region, image_id, state in copies
+            if state not in ('available', 'exists')
+        ]
+        if failed:
+            raise ResourceError(
+                "Failed to copy the AMI: {}.".format(", ".join(failed)))
+    print("Done.")
+
+
+def _print_snapshot_progress(snapshots):
+    num_completed = sum(s.state == 'completed' for s in snapshots)
+    progress = sum(
+        float((s.progress or '0%').rstrip('%') or 0) for s in snapshots
+    ) / max(len(snapshots), 1)
+    print("\r...{}/{} completed ({:.0f}%)".format(
+        num_completed, len(snapshots), progress), end="")
+    utils.STDOUT.flush()
+
+
+def create_snapshots(args):
+    """Snapshot the data volumes of the spot fleet."""
+    project = api.Project(args.config_dir)
+    print("Creating snapshots of the {} volumes...".format(args.device))
+    snapshots = project.create_snapshots(
+        device=args.device,
+        retention_days=args.retention_days,
+        max_concurrency=args.max_concurrency)
+    for snapshot in snapshots:
+        print("...{} - {}".format(snapshot.volume_id, snapshot.id))
+    if not args.no_wait:
+        snapshots = project.wait_for_snapshots(
+            [snapshot.id for snapshot in snapshots],
+            callback=_print_snapshot_progress)
+        print()
+        failed = [s.id for s in snapshots if s.state != 'completed']
+        if failed:
+            print("{}WARNING{}: Snapshots {} are in the error state."
+                  .format(utils.WARNING_COLOR, utils.RESET_COLOR,
+                          ", ".join(failed)))
+    print("Done.")
+
+
+def copy_snapshots(args):
+    """Copy snapshots to other regions."""
+    project = api.Project(args.config_dir)
+    snapshot_ids = args.snapshot_ids
+    if not snapshot_ids:
+        snapshot_ids = [s.id for s in project.latest_snapshots()]
+    if not snapshot_ids:
+        print("No snapshots were taken by this project. Nothing to copy.")
+        return
+
+    # Only completed snapshots can be copied
+    print("Waiting on the snapshots to complete:")
+    project.wait_for_snapshots(snapshot_ids, callback=_print_snapshot_progress)
+    print()
+    print("Copying {} snapshot(s) to {}...".format(
+        len(snapshot_ids), ", ".join(args.regions)))
+    copies = project.copy_snapshots(
+        snapshot_ids, args.regions, max_concurrency=args.max_concurrency)
+    for region, snapshot_id, copy_id in copies:
+        print("...{} - {} in {}".format(snapshot_id, copy_id, region))
+    if not args.no_wait:
+        for region in args.regions:
+            print("Waiting on copies in {}:".format(region))
+            project.wait_for_snapshots(
+                [copy_id for r, _, copy_id in copies if r == region],
+                region=region, callback=_print_snapshot_progress)
+            print()
+    print("Done.")
+
+
+def prune_snapshots(args):
+    """Delete the expired snapshots of the project."""
+    project = api.Project(args.config_dir)
+    num_failed = 0
+    for region in [project.region] + args.regions:
+        deleted, failed = project.prune_snapshots(
+            keep=args.keep, region=region, dry_run=args.dry_run,
+            max_concurrency=args.max_concurrency)
+        print("{} {} expired snapshot(s) in {}{}".format(
+            "Found" if args.dry_run else "Deleted", len(deleted),
+            region or "the default region", ":" if deleted else "."))
+        for snapshot in deleted:
+            print("...{} ({}, expired {})".format(
+                snapshot.id, snapshot.tags.get(api.VOLUME_TAG),
+                snapshot.tags.get(api.EXPIRES_TAG)))
+        for snapshot, error in failed:
+            print("{}ERROR{}: Failed to delete {}: {}".format(
+                utils.ERROR_COLOR, utils.RESET_COLOR, snapshot.id, error))
+        num_failed += len(failed)
+    if num_failed:
+        raise ResourceError(
+            "Failed to delete {} expired snapshot(s).".format(num_failed))
+
+
 def display_spot_price_history(args):
     """Display the spot price history."""
-    current_datetime = datetime.datetime.utcnow()
-    start_datetime = current_datetime - datetime.timedelta(days=args.days)
-
-    response = _EC2.describe_spot_price_history(
-        StartTime=start_datetime,
-        InstanceTypes=[args.instance_type],
-        AvailabilityZone=args.availability_zone,
-        ProductDescriptions=['Linux/UNIX'])
+    prices = api.Project(args.config_dir).spot_prices(
+        args.instance_type,
+        days=args.days,
+        availability_zone=args.availability_zone)
 
     prices_per_zone = {}
-    for price in response['SpotPriceHistory']:
-        try:
-            prices_per_zone[price['AvailabilityZone']].append(
-                (price['Timestamp'], price['SpotPrice'])
-            )
-        except KeyError:
-            prices_per_zone[price['AvailabilityZone']] = [
-                (price['Timestamp'], price['SpotPrice'])
-            ]
+    for price in prices:
+        prices_per_zone.setdefault(price.availability_zone, []).append(price)
 
     print("\nLast %d prices for %s instances:" %
           (args.last_to_display, args.instance_type))
     for z, prices in sorted(prices_per_zone.items()):
         print("\n%s %s %s" % ('-' * 3, z, '-' * 35))
-        for p in sorted(prices)[-args.last_to_display:]:
-            print("%s UTC\t-\t%s" % (p[0], p[1]))
+        for p in prices[-args.last_to_display:]:
+            print("%s UTC\t-\t%s" % (p.timestamp, p.price))
     print()
 
 
 def request_spot_fleet(args):
     """Request a new fleet of spot instances."""
-    config = utils.load_config(args.config_dir)
-
-    if config['EC2']['spot_fleet'] is not None:
-        print("According to the current config, there already exists"
-              "an active spot fleet request: {spot_fleet_id}. "
-              "Before requesting a new spot fleet please cancel the existing "
-              "one to avoid resource leaks."
-              .format(spot_fleet_id=config['EC2']['spot_fleet']['id']))
-        return
-
-    # Resolve ValidUntil date
-    valid_from = datetime.datetime.utcnow()
-    valid_until = valid_from + datetime.timedelta(days=args.valid_days)
-    year, month, day = valid_until.year, valid_until.month, valid_until.day
-    valid_until = datetime.datetime(year, month, day)
-
-    request_config = {
-        'IamFleetRole': config['AWS']['iam_fleet_role_arn'],
-        'SpotPrice': args.spot_price,
-        'TargetCapacity': args.target_capacity,
-        'ValidUntil': valid_until,
-        'TerminateInstancesWithExpiration': True,
-        'LaunchSpecifications': [
-            {
-                'ImageId': args.image_id,
-                'InstanceType': args.instance_type,
-                'KeyName': config['AWS']['key_name'],
-                'Placement': {
-                    'AvailabilityZone': args.availability_zone,
-                },
-            },
-        ],
-        'AllocationStrategy': 'lowestPrice',
-        'Type': 'request',
-    }
-
-    response = _EC2.request_spot_fleet(SpotFleetRequestConfig=request_config)
-    config['EC2']['spot_fleet'] = {
-        'id': response['SpotFleetRequestId'],
-        'instances': [],
-    }
-    print("Requested a spot fleet:", response['SpotFleetRequestId'])
-    utils.save_config(config, args.config_dir)
+    spot_fleet_id = api.Project(args.config_dir).request_fleet(
+        image_id=args.image_id,
+        instance_type=args.instance_type,
+        target_capacity=args.target_capacity,
+        spot_price=args.spot_price,
+        valid_days=args.valid_days,
+        availability_zone=args.availability_zone)
+    print("Requested a spot fleet:", spot_fleet_id)
 
 
 def cancel_spot_fleet(args):
     """Cancel the fleet of spot instances."""
-    config = utils.load_config(args.config_dir)
+    project = api.Project(args.config_dir)
+    if project.config['EC2']['spot_fleet'] is not None:
+        print("Canceling spot fleet request {}..."
+              .format(project.config['EC2']['spot_fleet']['id']))
+    project.cancel_fleet()
+    print("Done.")
+
 
+def install_agent(args):
+    """Install the spot interruption agent on the specified instances."""
+    project = api.Project(args.config_dir)
+
+    instance_ids = list(args.instances)
+    if args.spot_fleet:
+        instance_ids += project.fleet_instance_ids()
+    user, hosts, key_filename = project.ssh_params(instance_ids)
+    if not hosts:
+        print("No running instances is available for the given request.")
+        return
+
+    print("Installing the spot interruption agent on {} instance(s)..."
+          .format(len(hosts)))
+    remote_dir = os.path.dirname(agent.REMOTE_PATH)
+    utils.ssh_run("mkdir -p {}".format(remote_dir), user, hosts, key_filename)
+    agent_path = os.path.splitext(agent.__file__)[0] + '.py'
+    utils.ssh_put(agent_path, agent.REMOTE_PATH, user, hosts, key_filename)
+
+    # (Re)start the agent in background, detached from the SSH session
+    agent_cmd = \
+        "$(command -v python3 || command -v python) {agent_path} " \
+        "--hook {hook} --interval {interval} " \
+        "--events_path {events_path}".format(
+            agent_path=agent.REMOTE_PATH,
+            hook=shlex_quote(args.hook),
+            interval=args.interval,
+            events_path=agent.EVENTS_PATH)
+    # The previous agent is found by its pid file: matching the command line
+    # (e.g., with `pkill -f`) would also kill the shell that starts the agent.
+    # The pid file is stale after a reboot (or on instances launched from a
+    # baked AMI), so the pid is only killed if it still runs the agent.
+    # The events of the previous agents are dropped.
+    start_cmd = \
+        "pid=$(cat {pid_path} 2>/dev/null); " \
+        "if [ -n \"$pid\" ] && [ \"$pid\" != $$ ] && " \
+        "grep -qaF {agent_path} /proc/$pid/cmdline 2>/dev/null; " \
+        "then kill $pid; fi; " \
+        "rm -f {events_path}; " \
+        "nohup {agent_cmd} > /dev/null 2>&1 & " \
+        "echo $! > {pid_path}".format(
+            pid_path=agent.PID_PATH,
+            agent_path=agent.REMOTE_PATH,
+            events_path=agent.EVENTS_PATH,
+            agent_cmd=agent_cmd)
+    utils.ssh_run(start_cmd, user, hosts, key_filename, pty=False)
+    print("Done.")
+
+
+def watch_fleet(args):
+    """Stream events reported by the agents running on the spot fleet."""
+    project = api.Project(args.config_dir)
+    config = project.config
     if config['EC2']['spot_fleet'] is None:
-        print("No active spot fleet requests. Nothing to cancel.")
+        print("No active spot fleet requests. Nothing to watch.")
         return
 
-    print("Canceling spot fleet request {}..."
+    print("Watching spot fleet {} (press Ctrl+C to stop)..."
           .format(config['EC2']['spot_fleet']['id']))
-    _EC2.cancel_spot_fleet_requests(
-        SpotFleetRequestIds=[config['EC2']['spot_fleet']['id']],
-        TerminateInstances=True)
-    print("Done.")
+    utils.STDOUT.flush()
+    read_cmd = "cat {} 2>/dev/null || true".format(agent.EVENTS_PATH)
+    num_seen_lines = {}
+    try:
+        while True:
+            # Instances come and go, so resolve the hosts on every poll
+            user, hosts, key_filename = project.ssh_params(
+                project.fleet_instance_ids())
+            results = {}
+            if hosts:
+                results = utils.ssh_run(
+                    read_cmd, user, hosts, key_filename,
+                    use_sudo=False, quiet=True,
+                    warn_only=True, skip_bad_hosts=True)
+            for host, output in sorted(results.items()):
+                if not isinstance(output, six.string_types):
+                    continue
+                lines = output.splitlines()
+                num_seen = num_seen_lines.get(host, 0)
+                if len(lines) < num_seen:
+                    # The log was reset by a reinstall of the agent
+                    num_seen = 0
+                for line in lines[num_seen:]:
+                    print("[{}] {}".format(host, line))
+                num_seen_lines[host] = len(lines)
+            utils.STDOUT.flush()
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        print()
 
-    config['EC2']['spot_fleet'] = None
-    utils.save_config(config, args.config_dir)
+
+def fleet_stats(args):
+    """Sample resource utilization of the spot fleet instances."""
+    project = api.Project(args.config_dir)
+    config = project.config
+    if config['EC2']['spot_fleet'] is None:
+        print("No active spot fleet requests. Nothing to sample.")
+        return
+
+    history = stats.History(args.config_dir)
+    sample_cmd = stats.sample_command(args.sample_interval)
+    # Watch rounds reuse the same SSH connection to every host
+    user, _, key_filename = project.ssh_params([])
+    sessions = utils.SSHSessions(user, key_filename)
+    header = "{:<48} {:>6} {:>6} {:>17} {:>17} {:>6}  {}".format(
+        "HOST", "CPU%", "MEM%", "DISK R/W (MB/s)", "NET RX/TX (MB/s)",
+        "GPU%", "IDLE")
+    try:
+        while True:
+            _, hosts, _ = project.ssh_params(project.fleet_instance_ids())
+            results = sessions.run(
+                sample_cmd, hosts, timeout=args.sample_interval + 30)
+
+            print(header)
+            num_idle = 0
+            for host, output in sorted(results.items()):
+                if not isinstance(output, six.string_types):
+                    continue
+                try:
+                    sample = stats.parse_sample(output, args.sample_interval)
+                except (ValueError, KeyError):
+                    print("{:<48} failed to sample".format(host))
+                    continue
+                history.add(host, sample)
+                _, cpu, mem, disk_r, disk_w, net_rx, net_tx, gpu = sample
+                idle_for = history.idle_for(
+                    host, args.cpu_threshold, args.gpu_threshold,
+                    disk_threshold=args.disk_threshold * 1e6,
+                    net_threshold=args.net_threshold * 1e6)
+                is_idle = idle_for >= args.idle_minutes * 60
+                num_idle += is_idle
+                print("{:<48} {:>6.1f} {:>6.1f} {:>8.1f}/{:<8.1f} "
+                      "{:>8.1f}/{:<8.1f} {:>6}  {}".format(
+                          host, cpu, mem,
+                          disk_r / 1e6, disk_w / 1e6,
+                          net_rx / 1e6, net_tx / 1e6,
+                          "-" if gpu is None else "{:.1f}".format(gpu),
+                          "{:.0f}m".format(idle_for / 60) if is_idle else ""))
+            history.save()
+            if num_idle:
+                print("{} instance(s) idle for at least {} minutes "
+                      "can be scaled in.".format(num_idle, args.idle_minutes))
+            print()
+            utils.STDOUT.flush()
+
+            if args.watch is None:
+                break
+            time.sleep(args.watch)
+    except KeyboardInterrupt:
+        history.save()
+    finally:
+        sessions.close()
 
 
 def create_efs(args):
     """Create an EFS."""
-    config = utils.load_config(args.config_dir)
+    project = api.Project(args.config_dir)
+    config = project.config
 
     if config['EFS'] is not None:
         create_another_efs = utils.yesno(
@@ -303,13 +789,13 @@ def create_efs(args):
 
     print("Creating an EFS with token '{}'...".format(args.creation_token))
     try:
-        response = _EFS.create_file_system(
+        response = project.efs.create_file_system(
             CreationToken=args.creation_token,
             PerformanceMode=args.performance_mode)
     except:
         print("File system with token '{}' already exists."
               .format(args.creation_token))
-        response = _EFS.describe_file_systems(
+        response = project.efs.describe_file_systems(
             CreationToken=args.creation_token)
         response = response['FileSystems'][0]
     config['EFS'] = {
@@ -322,7 +808,7 @@ def create_efs(args):
     # It seems like EFS doesn't have waiters (yet?)
     # We need to have EFS available before creating mount targets...
     request_callback = lambda : \
-        _EFS.describe_file_systems(
+        project.efs.describe_file_systems(
             FileSystemId=config['EFS']['id'])['FileSystems'][0]
     condition_callback = lambda response: \
         response['LifeCycleState'] != 'available'
@@ -330,7 +816,7 @@ def create_efs(args):
 
     print("Creating mount targets...")
     config['EFS']['mount_targets'] = {}
-    response = _EC2.describe_subnets(
+    response = project.ec2.describe_subnets(
         Filters=[
             {
                 'Name': 'availability-zone',
@@ -343,7 +829,7 @@ def create_efs(args):
     }
 
     # Read the existing mount targets
-    response = _EFS.describe_mount_targets(
+    response = project.efs.describe_mount_targets(
         FileSystemId=config['EFS']['id'])
     for mount_target in response['MountTargets']:
         if mount_target['SubnetId'] in subnets:
@@ -354,32 +840,33 @@ def create_efs(args):
             utils.STDOUT.flush()
 
     # Create mount targets (if necessary)
-    for subnet_id, availability_zone in subnets.iteritems():
+    for subnet_id, availability_zone in six.iteritems(subnets):
         if availability_zone in config['EFS']['mount_targets']:
             continue
         print("...in {} - ".format(availability_zone), end="")
         utils.STDOUT.flush()
-        response = _EFS.create_mount_target(
+        response = project.efs.create_mount_target(
             FileSystemId=config['EFS']['id'],
             SubnetId=subnet_id)
         config['EFS']['mount_targets'][availability_zone] = \
             str(response['MountTargetId'])
         # Wait on mount target being created...
         request_callback = lambda : \
-            _EFS.describe_mount_targets(
+            project.efs.describe_mount_targets(
                 MountTargetId=response['MountTargetId'])['MountTargets'][0]
         condition_callback = lambda response: \
             response['LifeCycleState'] != 'available'
         utils.wait(request_callback, condition_callback, sleep_time=3.0)
         print("done.")
 
-    utils.save_config(config, args.config_dir)
+    project.save()
     print("Done.")
 
 
 def delete_efs(args):
     """Delete EFS."""
-    config = utils.load_config(args.config_dir)
+    project = api.Project(args.config_dir)
+    config = project.config
     if config['EFS'] is None:
         print("No EFS is associated with this project. Nothing to delete.")
         return
@@ -394,13 +881,14 @@ def delete_efs(args):
         default=False)
     if delete_efs:
         print("Deleting EFS {} mount targets...".format(efs_id))
-        for availability_zone, mount_target_id in efs_mount_targets.iteritems():
+        for availability_zone, mount_target_id in \
+                six.iteritems(efs_mount_targets):
             print("...in {} - ".format(availability_zone), end="")
             utils.STDOUT.flush()
-            _EFS.delete_mount_target(MountTargetId=mount_target_id)
+            project.efs.delete_mount_target(MountTargetId=mount_target_id)
             # Wait on mount target being deleted...
             request_callback = lambda : \
-                _EFS.describe_mount_targets(
+                project.efs.describe_mount_targets(
                     MountTargetId=mount_target_id)['MountTargets'][0]
             condition_callback = lambda response: \
                 response['LifeCycleState'] != 'deleted'
@@ -408,10 +896,11 @@ def delete_efs(args):
             print("done.")
 
         print("Deleting EFS {}...".format(efs_id))
-        _EFS.delete_file_system(FileSystemId=efs_id)
+        project.efs.delete_file_system(FileSystemId=efs_id)
         # Wait on file system being deleted...
         request_callback = lambda : \
-            _EFS.describe_file_systems(FileSystemId=efs_id)['FileSystems'][0]
+            project.efs.describe_file_systems(
+                FileSystemId=efs_id)['FileSystems'][0]
         condition_callback = lambda response: \
             response['LifeCycleState'] != 'deleted'
         utils.wait(request_callback, condition_callback, sleep_time=3.0)
@@ -420,99 +909,50 @@ def delete_efs(args):
     else:
         print("Deletion canceled.")
 
-    utils.save_config(config, args.config_dir)
+    project.save()
 
 
 def mount_efs(args):
     """Mount EFS to specified instances."""
-    config = utils.load_config(args.config_dir)
-    if config['EFS'] is None:
-        print("No EFS is associated with this project. Nothing to mount.")
-        return
-
-    instance_ids = args.instances
-    if args.spot_fleet:
-        response = _EC2.describe_spot_fleet_instances(
-            SpotFleetRequestId=config['EC2']['spot_fleet']['id'])
-        instance_ids += [
-            instance['InstanceId'] for instance in response['ActiveInstances']
-        ]
-
-    response = _EC2.describe_instances(
-        InstanceIds=instance_ids,
-        Filters=[
-            {
-                'Name': 'instance-state-name',
-                'Values': ['running'],
-            },
-        ])
-    running_instances = response['Reservations'][0]['Instances']
-    if not running_instances:
-        print("No running instances is available for the given request.")
-        return
-
-    # Construct SSH connection parameters
-    user = 'ubuntu'
-    hosts = [i['PublicDnsName'] for i in running_instances]
-    key_filename = os.path.join(
-        os.path.expandvars("$HOME/.ssh"),
-        "{}.pem".format(config['AWS']['key_name'].lower()))
-
-    # Construct EFS mount command
-    efs_dns_name = "{efs_id}.efs.{aws_region}.amazonaws.com".format(
-        efs_id=config['EFS']['id'],
-        aws_region=config['AWS']['region'])
-    mount_cmd = \
-        "mount -t nfs4 " \
-        "-o nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2 " \
-        "{efs_dns_name}:/ {efs_mount_point}".format(
-            efs_dns_name=efs_dns_name,
-            efs_mount_point=config['EFS']['token'])
-
-    # Mount EFS on each of the instances
-    results = utils.ssh_run(mount_cmd, user, hosts, key_filename)
+    api.Project(args.config_dir).mount_efs(
+        instance_ids=args.instances, spot_fleet=args.spot_fleet)
     print("Done.")
 
 
 def umount_efs(args):
     """Unmount EFS from specified instances."""
-    config = utils.load_config(args.config_dir)
-    if config['EFS'] is None:
-        print("No EFS is associated with this project. Nothing to unmount.")
-        return
+    api.Project(args.config_dir).umount_efs(
+        instance_ids=args.instances, spot_fleet=args.spot_fleet)
+    print("Done.")
 
-    instance_ids = args.instances
-    if args.spot_fleet:
-        response = _EC2.describe_spot_fleet_instances(
-            SpotFleetRequestId=config['EC2']['spot_fleet']['id'])
-        instance_ids += [
-            instance['InstanceId'] for instance in response['ActiveInstances']
-        ]
 
-    response = _EC2.describe_instances(
-        InstanceIds=instance_ids,
-        Filters=[
-            {
-                'Name': 'instance-state-name',
-                'Values': ['running'],
-            },
-        ])
-    running_instances = response['Reservations'][0]['Instances']
-    if not running_instances:
-        print("No running instances is available for the given request.")
+def start_daemon(args):
+    """Start the background daemon."""
+    pid = daemon.ping()
+    if pid is not None:
+        print("The daemon is already running (pid {}).".format(pid))
         return
+    pid = daemon.start(cache_ttl=args.cache_ttl)
+    if pid is None:
+        print("{}ERROR{}: Failed to start the daemon."
+              .format(utils.ERROR_COLOR, utils.RESET_COLOR))
+        sys.exit(1)
+    print("Started the daemon (pid {}).".format(pid))
+
+
+def stop_daemon(args):
+    """Stop the background daemon."""
+    if daemon.stop():
+        print("Stopped the daemon.")
+    else:
+        print("The daemon is not running.")
 
-    # Construct SSH connection parameters
-    user = 'ubuntu'
-    hosts = [i['PublicDnsName'] for i in running_instances]
-    key_filename = os.path.join(
-        os.path.expandvars("$HOME/.ssh"),
-        "{}.pem".format(config['AWS']['key_name'].lower()))
-
-    # Construct EFS unmount command
-    umount_cmd = "umount {efs_mount_point}".format(
-        efs_mount_point=config['EFS']['token'])
 
-    # Mount EFS on each of the instances
-    results = utils.ssh_run(umount_cmd, user, hosts, key_filename)
-    print("Done.")
+def daemon_status(args):
+    """Show whether the background daemon is running."""
+    pid = daemon.ping()
+    if pid is None:
+        print("The daemon is not running.")
+    else:
+        print("The daemon is running (pid {}) on '{}'."
+              .format(pid, daemon.socket_path()))
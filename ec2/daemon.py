@@ -0,0 +1,343 @@
+"""
+A warm background daemon that serves CLI requests over a Unix socket.
+
+Every `ec2` invocation pays for loading botocore models, building AWS
+clients, and parsing the config. The daemon keeps all of that (as well as
+SSH connections and a short-lived cache of API responses) in memory. When
+it is running, `ec2.run` forwards the command line to the daemon and streams
+the output back; otherwise, the command is executed in-process.
+
+The module is imported on every invocation, so it must only depend on the
+standard library at the module level.
+"""
+from __future__ import absolute_import, print_function
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from .exceptions import DaemonError
+
+# Commands are not forwarded if the environment of the client differs
+_ENV_PREFIXES = ('AWS_', 'BOTO_')
+_CONNECT_TIMEOUT = 5.0
+
+
+def socket_path():
+    """Return the path of the per-user daemon socket."""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    return os.path.join(runtime_dir, 'ec2-daemon-{}.sock'.format(os.getuid()))
+
+
+def _aws_environ():
+    return dict(
+        (key, value) for key, value in os.environ.items()
+        if key.startswith(_ENV_PREFIXES))
+
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message) + '\n').encode('utf-8'))
+
+
+def _connect(path=None, timeout=None):
+    """Connect to the daemon; return None if it is not running."""
+    path = path or socket_path()
+    try:
+        # Never talk to a socket that belongs to somebody else
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # A stuck daemon is treated as not running
+        conn.settimeout(_CONNECT_TIMEOUT)
+        conn.connect(path)
+        conn.settimeout(timeout)
+    except (OSError, socket.error):
+        return None
+    return conn
+
+
+def request(message, path=None, stdout=None, stderr=None, timeout=None):
+    """Send a request to the daemon and stream its output.
+
+    Returns the final response of the daemon or None if the daemon is not
+    running. Raises DaemonError if the request might have been received but
+    no final response arrived: the request must not be executed again.
+    """
+    stdout = stdout or sys.stdout
+    stderr = stderr or sys.stderr
+    conn = _connect(path, timeout)
+    if conn is None:
+        return None
+    try:
+        _send(conn, message)
+        for line in conn.makefile('rb'):
+            response = json.loads(line.decode('utf-8'))
+            if 'stream' in response:
+                stream = stdout if response['stream'] == 'stdout' else stderr
+                stream.write(response['data'])
+                stream.flush()
+            else:
+                return response
+    except (OSError, socket.error) as e:
+        raise DaemonError(
+            "Lost the connection to the daemon: {}".format(e))
+    except ValueError as e:
+        raise DaemonError(
+            "Received an invalid response from the daemon: {}".format(e))
+    finally:
+        conn.close()
+    raise DaemonError("The daemon closed the connection before responding.")
+
+
+def forward(argv):
+    """Forward the command line to the daemon.
+
+    Returns the exit code of the command or None if it has to be executed
+    in-process, i.e., if the daemon is not running or has explicitly
+    declined the command.
+    """
+    try:
+        response = request({
+            'argv': list(argv),
+            'cwd': os.getcwd(),
+            'env': _aws_environ(),
+        })
+    except DaemonError as e:
+        # The command might have been (partially) executed by the daemon
+        print("ERROR: {}".format(e), file=sys.stderr)
+        return 1
+    if response is None or response.get('fallback'):
+        return None
+    return response.get('exit', 1)
+
+
+class _StreamWriter(object):
+    """A file-like object that sends everything written to the client."""
+
+    encoding = 'utf-8'
+
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._name = name
+
+    def write(self, data):
+        if not isinstance(data, type(u'')):
+            data = data.decode('utf-8')
+        if data:
+            _send(self._conn, {'stream': self._name, 'data': data})
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _runs_locally(args):
+    """Check whether the command has to be executed by the client.
+
+    Interactive commands need the client's terminal, and long-running ones
+    would block the daemon for everybody else.
+    """
+    return getattr(args, 'local', False) or \
+        getattr(args, 'watch', None) is not None
+
+
+class Daemon(object):
+    """Executes CLI requests in a warm process.
+
+    Every connection is served by its own thread, but commands are executed
+    one at a time (they share the process-wide standard streams and working
+    directory): while a command is running, other commands are sent back to
+    be executed by their clients.
+    """
+
+    def __init__(self, path=None, cache_ttl=5.0, read_timeout=5.0):
+        self.path = path or socket_path()
+        self.cache_ttl = cache_ttl
+        self.read_timeout = read_timeout
+        self._command_lock = threading.Lock()
+        self._shutdown = threading.Event()
+
+    def warm_up(self):
+        from . import throttle
+        from . import utils
+
+        utils.KEEP_SSH_CONNECTIONS = True
+        throttle.enable_cache(self.cache_ttl)
+        # Load the botocore models of the most used services
+        for service in ('ec2', 'efs'):
+            try:
+                throttle.client(service)
+            except Exception:
+                traceback.print_exc()
+
+    def execute(self, conn, message):
+        """Execute the command and return its exit code (None to fall back)."""
+        from . import utils
+        from .cli import parse_args
+        from .exceptions import Ec2Error
+
+        if message.get('env', {}) != _aws_environ():
+            return None
+
+        stdout = _StreamWriter(conn, 'stdout')
+        stderr = _StreamWriter(conn, 'stderr')
+        saved = (sys.stdout, sys.stderr, utils.STDOUT, utils.STDERR,
+                 utils.STDIN, os.getcwd())
+        sys.stdout = utils.STDOUT = stdout
+        sys.stderr = utils.STDERR = stderr
+        utils.STDIN = open(os.devnull)
+        try:
+            os.chdir(message['cwd'])
+            args = parse_args(message['argv'])
+            if _runs_locally(args):
+                return None
+            args.cmd(args)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print(e.code, file=sys.stderr)
+            return 1
+        except Ec2Error as e:
+            print("{}ERROR{}: {}".format(
+                utils.ERROR_COLOR, utils.RESET_COLOR, e))
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 1
+        finally:
+            utils.STDIN.close()
+            (sys.stdout, sys.stderr, utils.STDOUT, utils.STDERR,
+             utils.STDIN, cwd) = saved
+            os.chdir(cwd)
+        return 0
+
+    def handle(self, conn):
+        """Handle a single request; return False to shut the daemon down."""
+        # A client that connects and sends nothing must not hold a thread
+        conn.settimeout(self.read_timeout)
+        line = conn.makefile('rb').readline()
+        if not line:
+            return True
+        conn.settimeout(None)
+        message = json.loads(line.decode('utf-8'))
+        command = message.get('command')
+        if command == 'ping':
+            _send(conn, {'exit': 0, 'pid': os.getpid()})
+        elif command == 'shutdown':
+            _send(conn, {'exit': 0})
+            return False
+        elif not self._command_lock.acquire(False):
+            # Another command is running: let the client execute this one
+            _send(conn, {'fallback': True})
+        else:
+            try:
+                exit_code = self.execute(conn, message)
+            finally:
+                self._command_lock.release()
+            if exit_code is None:
+                _send(conn, {'fallback': True})
+            else:
+                _send(conn, {'exit': exit_code})
+        return True
+
+    def _serve_connection(self, conn):
+        try:
+            if not self.handle(conn):
+                self._shutdown.set()
+        except (OSError, socket.error, ValueError):
+            # The streams of the process might be redirected to a client
+            traceback.print_exc(file=sys.__stderr__)
+        finally:
+            conn.close()
+
+    def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        self.warm_up()
+        print("Serving ec2 requests on '{}'...".format(self.path))
+        sys.stdout.flush()
+        # Wake up regularly to check whether the daemon has to shut down
+        server.settimeout(0.5)
+        try:
+            while not self._shutdown.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    continue
+                thread = threading.Thread(
+                    target=self._serve_connection, args=(conn,))
+                thread.start()
+        finally:
+            server.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+def ping(path=None):
+    """Return the pid of the running daemon or None."""
+    try:
+        response = request({'command': 'ping'}, path=path, timeout=5.0)
+    except DaemonError:
+        return None
+    return None if response is None else response.get('pid')
+
+
+def start(log_path=None, cache_ttl=5.0, timeout=30.0):
+    """Start the daemon in background and return its pid."""
+    pid = ping()
+    if pid is not None:
+        return pid
+    log_path = log_path or socket_path()[:-len('.sock')] + '.log'
+    with open(log_path, 'a') as log:
+        subprocess.Popen(
+            [sys.executable, '-m', 'ec2.daemon',
+             '--cache_ttl', str(cache_ttl)],
+            stdin=open(os.devnull), stdout=log, stderr=log,
+            close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pid = ping()
+        if pid is not None:
+            return pid
+        time.sleep(0.1)
+    return None
+
+
+def stop():
+    """Stop the daemon; return False if it was not running."""
+    return request({'command': 'shutdown'}, timeout=30.0) is not None
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="ec2-daemon",
+        description="Serve ec2 requests over a Unix socket.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--socket", default=socket_path(),
+                        help="path of the Unix socket")
+    parser.add_argument("--cache_ttl", type=float, default=5.0,
+                        help="how long (in seconds) to cache API responses")
+    args = parser.parse_args(argv)
+
+    Daemon(args.socket, cache_ttl=args.cache_ttl).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,23 @@
+"""
+Exceptions raised by ec2.
+"""
+
+
+class Ec2Error(Exception):
+    """Base class of all ec2 errors."""
+
+
+class ConfigError(Ec2Error):
+    """The project config is missing or invalid."""
+
+
+class ResourceError(Ec2Error):
+    """A resource is missing or is in a state that forbids the operation."""
+
+
+class RemoteError(Ec2Error):
+    """A command failed on (or could not reach) a remote host."""
+
+
+class DaemonError(Ec2Error):
+    """The daemon failed to complete a request it has accepted."""
@@ -0,0 +1,196 @@
+"""
+Resource utilization sampling of the fleet instances.
+
+Each sample is collected by a single shell command executed over one SSH
+session per host: the command reads the kernel counters from `/proc` twice,
+a short interval apart, and queries `nvidia-smi` if it is available. Reading
+a handful of `/proc` files costs a negligible amount of CPU on the node.
+
+Samples are kept locally as a compact rolling time series that is used to
+detect instances that have been idle for a while.
+"""
+from __future__ import absolute_import, division
+
+import json
+import os
+import re
+import time
+
+
+STATS_FILENAME = '.ec2.stats.json'
+
+# Order of the metrics in the stored samples
+METRICS = (
+    'time', 'cpu', 'mem', 'disk_read', 'disk_write', 'net_rx', 'net_tx', 'gpu'
+)
+
+_SECTOR_SIZE = 512
+_PARTITION_RE = re.compile(r'^((sd|vd|xvd)[a-z]+\d+|nvme\d+n\d+p\d+)$')
+_IGNORED_DEVICE_RE = re.compile(r'^(loop|ram|dm-)')
+
+_SNAPSHOT_CMD = \
+    "echo @stat; head -n 1 /proc/stat; " \
+    "echo @meminfo; grep -E '^(MemTotal|MemAvailable):' /proc/meminfo; " \
+    "echo @diskstats; cat /proc/diskstats; " \
+    "echo @netdev; tail -n +3 /proc/net/dev; " \
+    "echo @end"
+_GPU_CMD = \
+    "echo @gpu; nvidia-smi " \
+    "--query-gpu=utilization.gpu --format=csv,noheader,nounits " \
+    "2>/dev/null || true"
+
+
+def sample_command(interval=1.0):
+    """Return a shell command that prints a raw utilization sample."""
+    return "{snapshot}; sleep {interval}; {snapshot}; {gpu}".format(
+        snapshot=_SNAPSHOT_CMD, interval=interval, gpu=_GPU_CMD)
+
+
+def _split_sections(output):
+    sections = []
+    current = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('@'):
+            current = (line[1:], [])
+            sections.append(current)
+        elif current is not None and line:
+            current[1].append(line)
+    return sections
+
+
+def _parse_snapshot(sections):
+    snapshot = {}
+    for name, lines in sections:
+        if name == 'stat' and lines:
+            values = [int(v) for v in lines[0].split()[1:]]
+            # idle and iowait are the 4th and 5th fields
+            idle = sum(values[3:5])
+            snapshot['cpu'] = (sum(values) - idle, sum(values))
+        elif name == 'meminfo':
+            meminfo = {}
+            for line in lines:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+            snapshot['mem'] = (meminfo.get('MemTotal', 0),
+                               meminfo.get('MemAvailable', 0))
+        elif name == 'diskstats':
+            read, write = 0, 0
+            for line in lines:
+                fields = line.split()
+                if len(fields) < 10:
+                    continue
+                device = fields[2]
+                if (_IGNORED_DEVICE_RE.match(device) or
+                        _PARTITION_RE.match(device)):
+                    continue
+                read += int(fields[5])
+                write += int(fields[9])
+            snapshot['disk'] = (read * _SECTOR_SIZE, write * _SECTOR_SIZE)
+        elif name == 'netdev':
+            rx, tx = 0, 0
+            for line in lines:
+                interface, counters = line.split(':', 1)
+                if interface.strip() == 'lo':
+                    continue
+                counters = counters.split()
+                rx += int(counters[0])
+                tx += int(counters[8])
+            snapshot['net'] = (rx, tx)
+    return snapshot
+
+
+def parse_sample(output, interval=1.0, timestamp=None):
+    """Parse the output of `sample_command` into a list of metrics.
+
+    The metrics are ordered as in `METRICS`: CPU, memory and GPU utilization
+    are in percent, disk and network throughputs are in bytes per second.
+    GPU utilization is None if the instance has no GPUs.
+    """
+    sections = _split_sections(output)
+    ends = [i for i, (name, _) in enumerate(sections) if name == 'end']
+    if len(ends) < 2:
+        raise ValueError("Incomplete utilization sample.")
+    before = _parse_snapshot(sections[:ends[0]])
+    after = _parse_snapshot(sections[ends[0] + 1:ends[1]])
+
+    busy = after['cpu'][0] - before['cpu'][0]
+    total = after['cpu'][1] - before['cpu'][1]
+    cpu = 100. * busy / total if total > 0 else 0.
+    mem_total, mem_available = after['mem']
+    mem = 100. * (mem_total - mem_available) / mem_total if mem_total else 0.
+    disk_read, disk_write = [
+        (a - b) / interval for a, b in zip(after['disk'], before['disk'])
+    ]
+    net_rx, net_tx = [
+        (a - b) / interval for a, b in zip(after['net'], before['net'])
+    ]
+
+    gpu = None
+    for name, lines in sections[ends[1] + 1:]:
+        if name == 'gpu' and lines:
+            try:
+                values = [float(line) for line in lines]
+            except ValueError:
+                continue
+            gpu = sum(values) / len(values)
+
+    if timestamp is None:
+        timestamp = time.time()
+    return [round(timestamp, 1), round(cpu, 1), round(mem, 1),
+            round(disk_read), round(disk_write),
+            round(net_rx), round(net_tx),
+            None if gpu is None else round(gpu, 1)]
+
+
+class History(object):
+    """A rolling time series of utilization samples stored per host."""
+
+    def __init__(self, config_dir, max_age=24 * 3600):
+        self.path = os.path.join(config_dir, STATS_FILENAME)
+        self.max_age = max_age
+        self.samples = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as fp:
+                self.samples = json.load(fp)
+
+    def add(self, host, sample):
+        self.samples.setdefault(host, []).append(sample)
+
+    def trim(self, now=None):
+        """Drop the samples (and hosts) older than `max_age` seconds."""
+        if now is None:
+            now = time.time()
+        for host in list(self.samples):
+            samples = [s for s in self.samples[host]
+                       if now - s[0] <= self.max_age]
+            if samples:
+                self.samples[host] = samples
+            else:
+                del self.samples[host]
+
+    def save(self):
+        self.trim()
+        with open(self.path, 'w') as fp:
+            json.dump(self.samples, fp, separators=(',', ':'))
+
+    def idle_for(self, host, cpu_threshold=5., gpu_threshold=5.,
+                 disk_threshold=1e6, net_threshold=1e6, now=None):
+        """Return for how many seconds the host has been idle in a row.
+
+        A host is idle while its CPU and GPU utilization (in percent) as well
+        as its disk and network throughputs (in bytes per second, summed over
+        both directions) stay below the thresholds.
+        """
+        if now is None:
+            now = time.time()
+        since = None
+        for sample in reversed(self.samples.get(host, [])):
+            _, cpu, _, disk_read, disk_write, net_rx, net_tx, gpu = sample
+            if (cpu >= cpu_threshold or
+                    (gpu is not None and gpu >= gpu_threshold) or
+                    disk_read + disk_write >= disk_threshold or
+                    net_rx + net_tx >= net_threshold):
+                break
+            since = sample[0]
+        return 0. if since is None else now - since
@@ -0,0 +1,468 @@
+"""
+Process-wide rate limiting of AWS API calls.
+
+All AWS clients share a set of token buckets, one per service and API
+category (read-only `describe` calls and `mutate` calls), so that parallel
+commands do not exceed the account's API limits. The rate of each bucket
+adapts to throttling responses: it grows additively while calls succeed and
+shrinks multiplicatively when AWS pushes back (AIMD). Retries of throttled
+calls and of transient failures (connection errors, timeouts and 5xx
+responses) are paid from a retry budget that is replenished by successful
+calls, which prevents contention from turning into a retry storm.
+
+Long-running processes (e.g., `ec2 daemon`) can additionally enable a
+short-lived cache of the responses to `describe` calls, which is invalidated
+by any `mutate` call.
+
+The limits are configured by the optional `Throttle` section of `.ec2.yaml`
+of the first project loaded by the process:
+
+    Throttle:
+      rate: 5.0
+      min_rate: 0.5
+      max_rate: 20.0
+      burst: 10
+      services:
+        ec2:
+          mutate:
+            rate: 2.0
+"""
+from __future__ import absolute_import, division
+
+import copy
+import json
+import os
+import random
+import threading
+import time
+
+
+THROTTLING_ERROR_CODES = frozenset([
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'SlowDown',
+])
+
+# Server-side errors that are likely to go away on retry
+TRANSIENT_ERROR_CODES = frozenset([
+    'RequestTimeout',
+    'RequestTimeoutException',
+    'PriorRequestNotComplete',
+    'InternalError',
+    'InternalFailure',
+    'ServiceUnavailable',
+    'Unavailable',
+])
+
+# Names of the botocore exceptions raised when a request could not be sent or
+# its response was not received (connection errors, timeouts, etc.)
+_TRANSIENT_EXCEPTIONS = frozenset(['ConnectionError', 'HTTPClientError'])
+
+# Names of the botocore exceptions raised when a request has not reached AWS
+_UNSENT_EXCEPTIONS = frozenset([
+    'EndpointConnectionError',
+    'ConnectTimeoutError',
+])
+
+DEFAULTS = {
+    # Token bucket parameters (requests per second)
+    'rate': 5.0,
+    'min_rate': 0.5,
+    'max_rate': 20.0,
+    'burst': 10,
+    # AIMD parameters
+    'increase': 0.1,
+    'decrease': 0.5,
+    'cooldown': 1.0,
+    # Retry parameters
+    'retry_ratio': 0.1,
+    'min_retries': 10,
+    'max_attempts': 5,
+    'base_delay': 0.2,
+    'max_delay': 10.0,
+}
+
+
+_EPSILON = 1e-9
+_MIN_DELAY = 1e-3
+
+
+def api_category(operation_name):
+    """Return the API category of an operation, e.g., `describe_instances`."""
+    if operation_name.startswith(('describe_', 'list_', 'get_')):
+        return 'describe'
+    return 'mutate'
+
+
+def is_throttling_error(error):
+    """Check whether the exception is a throttling response from AWS."""
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+def is_transient_error(error):
+    """Check whether the exception is a transient (non-throttling) failure.
+
+    These are the errors botocore retries by default: connection errors,
+    timeouts and 5xx responses.
+    """
+    if any(cls.__name__ in _TRANSIENT_EXCEPTIONS
+           for cls in type(error).__mro__):
+        return True
+    response = getattr(error, 'response', None) or {}
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return response.get('Error', {}).get('Code') in TRANSIENT_ERROR_CODES or \
+        status >= 500
+
+
+def is_unsent_error(error):
+    """Check whether the exception was raised before the request was sent."""
+    return any(cls.__name__ in _UNSENT_EXCEPTIONS
+               for cls in type(error).__mro__)
+
+
+class AdaptiveTokenBucket(object):
+    """A thread-safe token bucket with an AIMD-adjusted refill rate."""
+
+    def __init__(self, rate, min_rate, max_rate, burst,
+                 increase=0.1, decrease=0.5, cooldown=1.0, clock=time.time,
+                 sleep=time.sleep):
+        self.rate = float(rate)
+        self.min_rate = float(min_rate)
+        self.max_rate = float(max_rate)
+        self.burst = float(burst)
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._last_refill = clock()
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0., now - self._last_refill)
+        self._tokens = min(self.burst, self._tokens + elapsed * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                # Refills can leave the bucket a rounding error short of
+                # a token, which would otherwise never be made up
+                if self._tokens >= 1. - _EPSILON:
+                    self._tokens -= 1.
+                    return
+                delay = max((1. - self._tokens) / self.rate, _MIN_DELAY)
+            self._sleep(delay)
+
+    def on_success(self):
+        """Additively increase the rate."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self):
+        """Multiplicatively decrease the rate and drain the bucket.
+
+        Throttling responses that arrive within a cooldown period after the
+        previous decrease are ignored, so that a single burst of rejections
+        does not collapse the rate to the minimum.
+        """
+        with self._lock:
+            now = self._clock()
+            if (self._last_decrease is not None and
+                    now - self._last_decrease < self.cooldown):
+                return
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.)
+            self._last_decrease = now
+
+
+class RetryBudget(object):
+    """Limits the number of retries to a fraction of successful calls."""
+
+    def __init__(self, ratio=0.1, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self._balance = float(min_retries)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self._balance + self.ratio,
+                                10. * self.min_retries)
+
+    def withdraw(self):
+        """Take a retry from the budget; return False if it is exhausted."""
+        with self._lock:
+            if self._balance < 1.:
+                return False
+            self._balance -= 1.
+            return True
+
+
+class RateLimiter(object):
+    """A registry of the token buckets and retry budgets of all services."""
+
+    def __init__(self, settings=None, clock=time.time, sleep=time.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self._buckets = {}
+        self._budgets = {}
+        self._lock = threading.Lock()
+        self.configure(settings)
+
+    def configure(self, settings=None):
+        """(Re)configure the limits from the `Throttle` config section.
+
+        The adapted rates are kept if the settings have not changed.
+        """
+        settings = dict(settings or {})
+        with self._lock:
+            if settings == getattr(self, '_raw_settings', None):
+                return
+            self._raw_settings = dict(settings)
+            self._services = settings.pop('services', None) or {}
+            self._settings = dict(DEFAULTS, **settings)
+            self._buckets.clear()
+            self._budgets.clear()
+
+    def settings(self, service, category=None):
+        settings = dict(self._settings)
+        service_settings = dict(self._services.get(service) or {})
+        category_settings = {
+            key: service_settings.pop(key) or {}
+            for key in ('describe', 'mutate') if key in service_settings
+        }
+        settings.update(service_settings)
+        if category is not None:
+            settings.update(category_settings.get(category, {}))
+        return settings
+
+    def bucket(self, service, category):
+        with self._lock:
+            key = (service, category)
+            if key not in self._buckets:
+                settings = self.settings(service, category)
+                self._buckets[key] = AdaptiveTokenBucket(
+                    rate=settings['rate'],
+                    min_rate=settings['min_rate'],
+                    max_rate=settings['max_rate'],
+                    burst=settings['burst'],
+                    increase=settings['increase'],
+                    decrease=settings['decrease'],
+                    cooldown=settings['cooldown'],
+                    clock=self._clock,
+                    sleep=self._sleep)
+            return self._buckets[key]
+
+    def budget(self, service):
+        with self._lock:
+            if service not in self._budgets:
+                settings = self.settings(service)
+                self._budgets[service] = RetryBudget(
+                    ratio=settings['retry_ratio'],
+                    min_retries=settings['min_retries'])
+            return self._budgets[service]
+
+    def call(self, service, operation_name, method, *args, **kwargs):
+        """Call the method respecting the limits of the service.
+
+        Throttled calls are retried. Other transient failures are retried
+        only for `describe` calls or if the request never reached AWS:
+        botocore generates a new idempotency token for every call, so a
+        retried `mutate` call might be executed twice.
+        """
+        category = api_category(operation_name)
+        bucket = self.bucket(service, category)
+        budget = self.budget(service)
+        settings = self.settings(service)
+        attempt = 0
+        while True:
+            attempt += 1
+            bucket.acquire()
+            try:
+                result = method(*args, **kwargs)
+            except Exception as e:
+                if is_throttling_error(e):
+                    bucket.on_throttle()
+                elif category == 'mutate' and not is_unsent_error(e):
+                    raise
+                elif not is_transient_error(e):
+                    raise
+                if attempt >= settings['max_attempts'] or \
+                        not budget.withdraw():
+                    raise
+                # Exponential backoff with full jitter
+                delay = min(settings['max_delay'],
+                            settings['base_delay'] * 2 ** (attempt - 1))
+                self._sleep(random.uniform(0, delay))
+                continue
+            bucket.on_success()
+            budget.deposit()
+            return result
+
+
+class ResponseCache(object):
+    """A short-lived cache of the responses to read-only API calls."""
+
+    def __init__(self, ttl=0., clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._responses = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._responses:
+                timestamp, response = self._responses[key]
+                if self._clock() - timestamp <= self.ttl:
+                    return copy.deepcopy(response)
+                del self._responses[key]
+        return None
+
+    def put(self, key, response):
+        with self._lock:
+            self._responses[key] = (self._clock(), copy.deepcopy(response))
+
+    def clear(self):
+        with self._lock:
+            self._responses.clear()
+
+
+class ThrottledClient(object):
+    """A proxy of a boto3 client that routes API calls through the limiter."""
+
+    def __init__(self, client, limiter, cache=None):
+        self._client = client
+        self._limiter = limiter
+        self._cache = cache
+        self._service = client.meta.service_model.service_name
+
+    def _call(self, operation_name, method, *args, **kwargs):
+        if self._cache is None or self._cache.ttl <= 0:
+            return self._limiter.call(
+                self._service, operation_name, method, *args, **kwargs)
+        if api_category(operation_name) != 'describe':
+            self._cache.clear()
+            return self._limiter.call(
+                self._service, operation_name, method, *args, **kwargs)
+        key = (self._service, self._client.meta.region_name, operation_name,
+               json.dumps(kwargs, sort_keys=True, default=str))
+        response = self._cache.get(key)
+        if response is None:
+            response = self._limiter.call(
+                self._service, operation_name, method, *args, **kwargs)
+            self._cache.put(key, response)
+        return response
+
+    def _wrap(self, operation_name, method):
+        def throttled_method(*args, **kwargs):
+            return self._call(operation_name, method, *args, **kwargs)
+        throttled_method.__name__ = operation_name
+        throttled_method.__doc__ = method.__doc__
+        return throttled_method
+
+    def _load_model(self, type_name):
+        """Load the paginator or waiter definitions of the service."""
+        service_model = self._client.meta.service_model
+        return _loader().load_service_model(
+            service_model.service_name, type_name, service_model.api_version)
+
+    def get_paginator(self, operation_name):
+        from botocore.paginate import Paginator, PaginatorModel
+
+        if not self._client.can_paginate(operation_name):
+            # Raises the same error as the client
+            return self._client.get_paginator(operation_name)
+        api_name = self._client.meta.method_to_api_mapping[operation_name]
+        model = PaginatorModel(self._load_model('paginators-1'))
+        # Pages are requested through the throttled method of the proxy
+        return Paginator(
+            getattr(self, operation_name), model.get_paginator(api_name),
+            self._client.meta.service_model.operation_model(api_name))
+
+    def get_waiter(self, waiter_name):
+        from botocore import xform_name
+        from botocore.waiter import WaiterModel, create_waiter_with_client
+
+        if waiter_name not in self._client.waiter_names:
+            # Raises the same error as the client
+            return self._client.get_waiter(waiter_name)
+        model = WaiterModel(self._load_model('waiters-2'))
+        names = {xform_name(name): name for name in model.waiter_names}
+        # The waiter polls through the throttled methods of the proxy
+        return create_waiter_with_client(names[waiter_name], model, self)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name in self._client.meta.method_to_api_mapping:
+            return self._wrap(name, attr)
+        return attr
+
+
+# The limiter and the cache shared by all clients of the process
+_LIMITER = RateLimiter()
+_CACHE = ResponseCache()
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+_CONFIGURED = False
+_LOADER = None
+
+
+def _loader():
+    """Return the shared loader of botocore data (paginators, waiters)."""
+    global _LOADER
+    from botocore.loaders import create_loader
+
+    with _CLIENTS_LOCK:
+        if _LOADER is None:
+            _LOADER = create_loader(os.environ.get('AWS_DATA_PATH'))
+        return _LOADER
+
+
+def configure(settings=None):
+    """Configure the shared limiter from the `Throttle` config section.
+
+    The limits are per process, so only the first call has an effect: the
+    configs of other projects loaded later (e.g., by `ec2 status`) neither
+    override the limits nor reset the adapted rates.
+    """
+    global _CONFIGURED
+    with _CLIENTS_LOCK:
+        if _CONFIGURED:
+            return
+        _CONFIGURED = True
+    _LIMITER.configure(settings)
+
+
+def enable_cache(ttl):
+    """Cache responses to `describe` calls for the given number of seconds."""
+    _CACHE.ttl = ttl
+    _CACHE.clear()
+
+
+def client(service, region_name=None):
+    """Return a shared rate-limited boto3 client of the service."""
+    import boto3
+    from botocore.config import Config
+
+    with _CLIENTS_LOCK:
+        key = (service, region_name)
+        if key not in _CLIENTS:
+            # Retries (of both throttled calls and transient errors) are
+            # handled by the shared limiter and retry budget
+            raw_client = boto3.client(
+                service, region_name=region_name,
+                config=Config(retries={'max_attempts': 0}))
+            _CLIENTS[key] = ThrottledClient(raw_client, _LIMITER, _CACHE)
+        return _CLIENTS[key]
@@ -1,14 +1,23 @@
 import os
 import sys
+import copy
 import time
 import yaml
 import getpass as gp
+import hashlib
 import logging
+import threading
+import paramiko
+
+from multiprocessing.pool import ThreadPool
 
 from fabric.tasks import execute
-from fabric.api import settings, sudo, run
+from fabric.api import settings, hide, parallel, sudo, run, put
 from fabric.network import disconnect_all
 
+from . import throttle
+from .exceptions import ConfigError, RemoteError
+
 log = logging.getLogger(__name__)
 
 PY3 = sys.version_info[0] == 3
@@ -17,6 +26,9 @@ STDIN = sys.stdin
 STDERR = sys.stderr
 STDOUT = sys.stdout
 
+# Whether to keep SSH connections open between calls (set by `ec2 daemon`)
+KEEP_SSH_CONNECTIONS = False
+
 WARNING_COLOR = "\033[33m"
 ERROR_COLOR = "\033[31m"
 RESET_COLOR = "\033[0m"
@@ -45,29 +57,55 @@ def yesno(prompt, default=True):
     return {'y': True, 'n': False}.get(raw.lower(), default)
 
 
+_CONFIG_CACHE = {}
+
+
 def load_config(config_dir):
     config_path = os.path.join(config_dir, '.ec2.yaml')
     if not os.path.isdir(config_dir):
-        print("{}ERROR{}: Directory '{}' does not exist."
-              .format(ERROR_COLOR, RESET_COLOR, config_dir))
-        sys.exit(1)
+        raise ConfigError(
+            "Directory '{}' does not exist.".format(config_dir))
     if not os.path.isfile(config_path):
-        print("{}ERROR{}: Cannot find ec2 configuration in '{}'. "
-              "Please run `configure` command in your project directory "
-              "to create a new '.ec2.yaml' config."
-              .format(ERROR_COLOR, RESET_COLOR, config_path))
-        sys.exit(1)
-    with open(config_path) as fp:
-        config = yaml.load(fp)
+        raise ConfigError(
+            "Cannot find ec2 configuration in '{}'. "
+            "Please run `configure` command in your project directory "
+            "to create a new '.ec2.yaml' config.".format(config_path))
+    # Configs are re-parsed only if changed (matters for `ec2 daemon`)
+    mtime = os.path.getmtime(config_path)
+    cached = _CONFIG_CACHE.get(config_path)
+    if cached is not None and cached[0] == mtime:
+        config = copy.deepcopy(cached[1])
+    else:
+        with open(config_path) as fp:
+            config = yaml.load(fp)
+        _CONFIG_CACHE[config_path] = (mtime, copy.deepcopy(config))
+    throttle.configure(config.get('Throttle'))
     return config
 
 
+def find_config_dirs(roots, max_depth=3):
+    """Find directories with ec2 configs under the given roots."""
+    config_dirs = []
+    for root in roots:
+        root = os.path.abspath(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            if '.ec2.yaml' in filenames:
+                config_dirs.append(dirpath)
+            depth = dirpath[len(root):].count(os.sep)
+            if depth >= max_depth:
+                dirnames[:] = []
+            else:
+                dirnames[:] = sorted(
+                    d for d in dirnames if not d.startswith('.'))
+    return config_dirs
+
+
 def save_config(config, config_dir):
     if not os.path.isdir(config_dir):
-        print("{}ERROR{}: Directory '{}' does not exist."
-              .format(ERROR_COLOR, RESET_COLOR, config_dir))
-        sys.exit(1)
+        raise ConfigError(
+            "Directory '{}' does not exist.".format(config_dir))
     config_path = os.path.join(config_dir, '.ec2.yaml')
+    _CONFIG_CACHE.pop(config_path, None)
     with open(config_path, 'w') as fp:
         yaml.dump(config, fp, default_flow_style=False)
 
@@ -82,10 +120,128 @@ def wait(request_callback, condition_callback, sleep_time=5.0):
             break
 
 
-def ssh_run(command, user, hosts, key_filename):
+def parallel_map(func, items, max_workers=8):
+    """Apply the function to the items in a pool of threads."""
+    items = list(items)
+    if not items:
+        return []
+    pool = ThreadPool(min(max_workers, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def content_hash(paths, extra=()):
+    """Compute a SHA-256 hash of the given files and extra strings."""
+    sha = hashlib.sha256()
+    for value in extra:
+        sha.update(u(value).encode('utf-8'))
+        sha.update(b'\0')
+    for path in sorted(paths):
+        sha.update(u(os.path.basename(path)).encode('utf-8'))
+        sha.update(b'\0')
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda : fp.read(1 << 16), b''):
+                sha.update(chunk)
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def ssh_run(command, user, hosts, key_filename, use_sudo=True, pty=True,
+            quiet=False, concurrent=False, **kwargs):
+    runner = sudo if use_sudo else run
+    task = lambda : runner(command, pty=pty)
+    if concurrent:
+        task = parallel(task)
+    managers = [hide('running', 'output')] if quiet else []
+    # Fabric exits the process on failures unless told to raise instead
+    kwargs.setdefault('abort_exception', RemoteError)
     try:
-        with settings(user=user, key_filename=key_filename):
-            results = execute(lambda : sudo(command), hosts=hosts)
+        with settings(*managers, user=user, key_filename=key_filename,
+                      **kwargs):
+            results = execute(task, hosts=hosts)
     finally:
-        disconnect_all()
+        if not KEEP_SSH_CONNECTIONS:
+            disconnect_all()
     return results
+
+
+def ssh_put(local_path, remote_path, user, hosts, key_filename, **kwargs):
+    kwargs.setdefault('abort_exception', RemoteError)
+    try:
+        with settings(user=user, key_filename=key_filename, **kwargs):
+            results = execute(
+                lambda : put(local_path, remote_path, use_sudo=True),
+                hosts=hosts)
+    finally:
+        if not KEEP_SSH_CONNECTIONS:
+            disconnect_all()
+    return results
+
+
+class SSHSessions(object):
+    """Persistent SSH connections to the hosts, one per host.
+
+    Unlike `ssh_run`, which connects to the hosts on every call, commands
+    run over connections that are kept open until `close` is called, so that
+    periodic commands (e.g., `fleet stats --watch`) do not pay for an SSH
+    handshake with every host every time.
+    """
+
+    def __init__(self, user, key_filename, timeout=10.):
+        self.user = user
+        self.key_filename = key_filename
+        self.timeout = timeout
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, host):
+        with self._lock:
+            client = self._clients.get(host)
+        transport = client and client.get_transport()
+        if transport is not None and transport.is_active():
+            return client
+        client = paramiko.SSHClient()
+        client.load_system_host_keys()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        client.connect(host, username=self.user,
+                       key_filename=self.key_filename, timeout=self.timeout)
+        with self._lock:
+            self._clients[host] = client
+        return client
+
+    def _disconnect(self, host):
+        with self._lock:
+            client = self._clients.pop(host, None)
+        if client is not None:
+            client.close()
+
+    def _run(self, host, command, timeout):
+        try:
+            client = self._connect(host)
+            _, stdout, _ = client.exec_command(command, timeout=timeout)
+            return stdout.read().decode('utf-8')
+        except Exception as e:
+            # Reconnect next time
+            self._disconnect(host)
+            return e
+
+    def run(self, command, hosts, timeout=None):
+        """Run the command on the hosts in parallel; return outputs per host.
+
+        The output of a host that failed is the raised exception. The hosts
+        that are not given are disconnected.
+        """
+        hosts = list(hosts)
+        for host in set(self._clients) - set(hosts):
+            self._disconnect(host)
+        outputs = parallel_map(
+            lambda host: self._run(host, command, timeout), hosts,
+            max_workers=32)
+        return dict(zip(hosts, outputs))
+
+    def close(self):
+        for host in list(self._clients):
+            self._disconnect(host)
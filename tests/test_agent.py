@@ -0,0 +1,98 @@
+"""
+Tests of the spot interruption agent against a local fake metadata service.
+"""
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from ec2 import agent
+
+TOKEN = 'fake-token'
+INSTANCE_ID = 'i-0123456789abcdef0'
+NOTICE = {'action': 'terminate', 'time': '2017-09-18T08:22:00Z'}
+
+
+class FakeMetadataHandler(BaseHTTPRequestHandler):
+    """Serves the instance id and a spot notice after a few polls."""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, body=''):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        server = self.server
+        if self.path != '/latest/api/token' or not server.imdsv2:
+            self._reply(403)
+            return
+        self._reply(200, TOKEN)
+
+    def do_GET(self):
+        server = self.server
+        token = self.headers.get('X-aws-ec2-metadata-token')
+        server.tokens.append(token)
+        if server.imdsv2 and token != TOKEN:
+            self._reply(401)
+        elif self.path == '/latest/meta-data/instance-id':
+            self._reply(200, INSTANCE_ID)
+        elif self.path == '/latest/meta-data/spot/instance-action':
+            server.num_polls += 1
+            if server.num_polls <= 2:
+                self._reply(404)
+            else:
+                self._reply(200, json.dumps(NOTICE))
+        else:
+            self._reply(404)
+
+
+@pytest.fixture(params=[True, False], ids=['imdsv2', 'imdsv1'])
+def metadata_server(request):
+    server = HTTPServer(('127.0.0.1', 0), FakeMetadataHandler)
+    server.imdsv2 = request.param
+    server.tokens = []
+    server.num_polls = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_watch_runs_hook_on_interruption(metadata_server, tmpdir):
+    client = agent.MetadataClient(
+        'http://127.0.0.1:{}'.format(metadata_server.server_port))
+    events_path = str(tmpdir.join('log', 'events.log'))
+    hook_path = str(tmpdir.join('hook'))
+
+    action = agent.watch(client, hook='touch {}'.format(hook_path),
+                         events_path=events_path, interval=0.01)
+
+    assert action == NOTICE
+    assert os.path.exists(hook_path)
+    assert metadata_server.num_polls == 3
+    with open(events_path) as fp:
+        events = [json.loads(line) for line in fp]
+    assert [e['event'] for e in events] == \
+        ['started', 'interruption', 'checkpoint']
+    assert all(e['instance_id'] == INSTANCE_ID for e in events)
+    assert events[1]['action'] == 'terminate'
+    assert events[1]['action_time'] == NOTICE['time']
+    assert events[2]['exit_code'] == 0
+
+    expected_token = TOKEN if metadata_server.imdsv2 else None
+    assert set(metadata_server.tokens) == {expected_token}
@@ -0,0 +1,90 @@
+"""
+Tests of the in-process API that do not need AWS access.
+"""
+from __future__ import absolute_import
+
+import pytest
+
+pytest.importorskip('fabric.api')
+pytest.importorskip('yaml')
+
+from ec2 import api
+from ec2 import throttle
+from ec2.exceptions import Ec2Error, RemoteError, ResourceError
+
+
+@pytest.fixture
+def project(tmpdir, monkeypatch):
+    project = api.Project(str(tmpdir))
+    project._config = {
+        'AWS': {'region': 'us-east-1', 'key_name': 'test'},
+        'EC2': {'spot_fleet': None},
+        'EFS': {'id': 'fs-12345678', 'token': '/efs'},
+    }
+    # Nothing listens on the port, so SSH fails to connect
+    monkeypatch.setattr(
+        project, 'ssh_params',
+        lambda instance_ids: ('ubuntu', ['127.0.0.1:1'], None))
+    return project
+
+
+@pytest.mark.parametrize('method', ['mount_efs', 'umount_efs'])
+def test_failing_host_raises_remote_error(project, method):
+    with pytest.raises(RemoteError) as info:
+        getattr(project, method)(instance_ids=['i-12345678'])
+    assert isinstance(info.value, Ec2Error)
+
+
+def make_snapshot(snapshot_id, volume_id, start_time, state='completed'):
+    return api.Snapshot(
+        id=snapshot_id, description=None, volume_id=volume_id, state=state,
+        progress='100%', start_time=start_time,
+        tags={api.VOLUME_TAG: volume_id,
+              api.EXPIRES_TAG: '2000-01-01T00:00:00Z'})
+
+
+class FakeMeta(object):
+    region_name = 'us-east-1'
+
+
+class FakeClient(object):
+
+    meta = FakeMeta()
+
+    def __init__(self, in_use=()):
+        self.in_use = set(in_use)
+        self.deleted = []
+
+    def delete_snapshot(self, SnapshotId):
+        if SnapshotId in self.in_use:
+            raise Exception("InvalidSnapshot.InUse")
+        self.deleted.append(SnapshotId)
+
+
+def test_prune_reports_failed_deletions(project, monkeypatch):
+    snapshots = [
+        make_snapshot('snap-{}'.format(i), 'vol-1', i) for i in range(4)
+    ]
+    client = FakeClient(in_use=['snap-1'])
+    monkeypatch.setattr(project, 'project_snapshots',
+                        lambda region=None: iter(snapshots))
+    monkeypatch.setattr(throttle, 'client', lambda *args, **kwargs: client)
+
+    deleted, failed = project.prune_snapshots(keep=1)
+    assert sorted(s.id for s in deleted) == ['snap-0', 'snap-2']
+    assert [(s.id, str(e)) for s, e in failed] == \
+        [('snap-1', 'InvalidSnapshot.InUse')]
+    assert sorted(client.deleted) == ['snap-0', 'snap-2']
+
+
+def test_copy_refuses_pending_snapshots(project, monkeypatch):
+    monkeypatch.setattr(
+        project, '_describe_snapshots',
+        lambda client, **kwargs: iter([
+            make_snapshot('snap-0', 'vol-1', 0),
+            make_snapshot('snap-1', 'vol-1', 1, state='pending'),
+        ]))
+    client = FakeClient()
+    monkeypatch.setattr(throttle, 'client', lambda *args, **kwargs: client)
+    with pytest.raises(ResourceError):
+        project.copy_snapshots(['snap-0', 'snap-1'], ['us-west-2'])
@@ -0,0 +1,120 @@
+"""
+Round-trip tests of the daemon over a real Unix socket.
+
+The commands are executed by a fake daemon, so the tests need neither AWS
+nor SSH access.
+"""
+from __future__ import absolute_import
+
+import io
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import pytest
+
+from ec2 import daemon
+
+
+class FakeDaemon(daemon.Daemon):
+    """Executes the commands given by the first argument."""
+
+    def __init__(self, path):
+        super(FakeDaemon, self).__init__(path, read_timeout=0.5)
+        self.executed = []
+        self.release = threading.Event()
+
+    def warm_up(self):
+        pass
+
+    def execute(self, conn, message):
+        command = message['argv'][0]
+        self.executed.append(command)
+        if command == 'echo':
+            daemon._StreamWriter(conn, 'stdout').write(message['argv'][1])
+            return 0
+        if command == 'fail':
+            return 3
+        if command == 'local':
+            return None
+        if command == 'drop':
+            conn.shutdown(socket.SHUT_RDWR)
+            return 0
+        if command == 'block':
+            self.release.wait(10)
+            return 0
+
+
+@pytest.fixture
+def server(monkeypatch):
+    runtime_dir = tempfile.mkdtemp()
+    monkeypatch.setenv('XDG_RUNTIME_DIR', runtime_dir)
+    fake = FakeDaemon(daemon.socket_path())
+    thread = threading.Thread(target=fake.serve)
+    thread.start()
+    for _ in range(100):
+        if daemon.ping() is not None:
+            break
+        time.sleep(0.05)
+    yield fake
+    fake.release.set()
+    daemon.stop()
+    thread.join(10)
+    shutil.rmtree(runtime_dir)
+
+
+def test_not_running(monkeypatch):
+    monkeypatch.setenv('XDG_RUNTIME_DIR', tempfile.mkdtemp())
+    assert daemon.ping() is None
+    assert daemon.forward(['echo', 'hello']) is None
+
+
+def test_ping(server):
+    assert daemon.ping() == os.getpid()
+
+
+def test_forward(server):
+    stdout = io.StringIO()
+    response = daemon.request({'argv': ['echo', u'hello\n']}, stdout=stdout)
+    assert response == {'exit': 0}
+    assert stdout.getvalue() == u'hello\n'
+    assert daemon.forward(['fail']) == 3
+    assert server.executed == ['echo', 'fail']
+
+
+def test_explicit_fallback(server):
+    assert daemon.forward(['local']) is None
+
+
+def test_dropped_connection_is_not_rerun(server, capsys):
+    # A non-None exit code means that the client does not run the command
+    assert daemon.forward(['drop']) == 1
+    assert "ERROR" in capsys.readouterr().err
+    assert server.executed == ['drop']
+
+
+def test_busy_daemon_falls_back(server):
+    thread = threading.Thread(target=daemon.forward, args=(['block'],))
+    thread.start()
+    while not server.executed:
+        time.sleep(0.01)
+    assert daemon.ping() == os.getpid()
+    assert daemon.forward(['echo', 'hello']) is None
+    server.release.set()
+    thread.join(10)
+    assert server.executed == ['block']
+
+
+def test_silent_client_does_not_block(server):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(daemon.socket_path())
+    try:
+        assert daemon.forward(['fail']) == 3
+        # The daemon gives up on the silent connection
+        conn.settimeout(5)
+        assert conn.recv(1) == b''
+    finally:
+        conn.close()
@@ -0,0 +1,88 @@
+"""
+Tests of utilization sample parsing and idle detection.
+"""
+from __future__ import absolute_import
+
+import pytest
+
+from ec2 import stats
+
+
+def snapshot(busy, idle, sectors_read, sectors_written, rx, tx):
+    return "\n".join([
+        "@stat",
+        "cpu  {} 0 0 {} 0 0 0 0 0 0".format(busy, idle),
+        "@meminfo",
+        "MemTotal:        1000 kB",
+        "MemAvailable:     250 kB",
+        "@diskstats",
+        "   8       0 sda 10 0 {} 0 5 0 {} 0 0 0 0".format(
+            sectors_read, sectors_written),
+        # Partitions and loop devices are not counted twice
+        "   8       1 sda1 10 0 {} 0 5 0 {} 0 0 0 0".format(
+            sectors_read, sectors_written),
+        "   7       0 loop0 10 0 999 0 5 0 999 0 0 0 0",
+        "@netdev",
+        "  eth0: {} 10 0 0 0 0 0 0 {} 20 0 0 0 0 0 0".format(rx, tx),
+        "    lo: 999 10 0 0 0 0 0 0 999 20 0 0 0 0 0 0",
+        "@end",
+    ])
+
+
+BEFORE = snapshot(100, 300, 1000, 2000, 10000, 20000)
+AFTER = snapshot(150, 350, 3000, 6000, 30000, 60000)
+
+
+def test_parse_sample():
+    output = "\n".join([BEFORE, AFTER, "@gpu", "40", "60"])
+    sample = stats.parse_sample(output, interval=2., timestamp=123.)
+    assert sample == [
+        123., 50., 75.,
+        2000 * 512 / 2, 4000 * 512 / 2,
+        10000, 20000,
+        50.,
+    ]
+
+
+def test_parse_sample_without_gpu():
+    # `nvidia-smi` is missing, so the GPU section is empty
+    output = "\n".join([BEFORE, AFTER, "@gpu"])
+    sample = stats.parse_sample(output, interval=2., timestamp=123.)
+    assert sample[stats.METRICS.index('gpu')] is None
+    assert sample[stats.METRICS.index('cpu')] == 50.
+
+
+def test_parse_incomplete_sample():
+    with pytest.raises(ValueError):
+        stats.parse_sample(BEFORE)
+
+
+def make_sample(time, cpu=0., disk=0., net=0., gpu=None):
+    return [time, cpu, 50., disk, 0, net, 0, gpu]
+
+
+@pytest.fixture
+def history(tmpdir):
+    return stats.History(str(tmpdir))
+
+
+def test_idle_for(history):
+    for time in range(0, 600, 60):
+        history.add('host', make_sample(time, cpu=90. if time < 300 else 1.))
+    assert history.idle_for('host', now=600.) == 300.
+    assert history.idle_for('unknown', now=600.) == 0.
+
+
+def test_busy_gpu_is_not_idle(history):
+    history.add('host', make_sample(0., gpu=1.))
+    history.add('host', make_sample(60., gpu=99.))
+    assert history.idle_for('host', now=120.) == 0.
+
+
+@pytest.mark.parametrize('metric', ['disk', 'net'])
+def test_data_staging_is_not_idle(history, metric):
+    history.add('host', make_sample(0.))
+    history.add('host', make_sample(60., **{metric: 50e6}))
+    assert history.idle_for('host', now=120.) == 0.
+    assert history.idle_for(
+        'host', now=120., **{metric + '_threshold': 100e6}) == 120.
@@ -0,0 +1,215 @@
+"""
+Tests of the adaptive rate limiter against a simulated AWS endpoint.
+
+The tests run on a fake clock, so they take no real time and do not need
+boto3 or AWS credentials.
+"""
+from __future__ import absolute_import, division
+
+import collections
+import random
+
+import pytest
+
+from ec2 import throttle
+
+
+class FakeClock(object):
+    """A clock that only advances when somebody sleeps."""
+
+    def __init__(self, now=1e6):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        assert seconds > 0, "sleeping for {} seconds".format(seconds)
+        self.now += seconds
+
+
+class ThrottlingError(Exception):
+
+    def __init__(self):
+        super(ThrottlingError, self).__init__("Rate exceeded")
+        self.response = {'Error': {'Code': 'RequestLimitExceeded'}}
+
+
+class ServerError(Exception):
+
+    def __init__(self):
+        super(ServerError, self).__init__("Service unavailable")
+        self.response = {
+            'Error': {'Code': 'Unavailable'},
+            'ResponseMetadata': {'HTTPStatusCode': 503},
+        }
+
+
+class ConnectionError(Exception):
+    """Mimics `botocore.exceptions.ConnectionError`."""
+
+
+class EndpointConnectionError(ConnectionError):
+    pass
+
+
+class HTTPClientError(Exception):
+    """Mimics `botocore.exceptions.HTTPClientError`."""
+
+
+class ReadTimeoutError(HTTPClientError):
+    pass
+
+
+class FakeEndpoint(object):
+    """An endpoint that rejects the calls above `max_rate` per second."""
+
+    def __init__(self, clock, max_rate):
+        self.clock = clock
+        self.max_rate = max_rate
+        self.accepted = []
+        self.rejected = []
+        self._window = collections.deque()
+
+    def describe_instances(self):
+        now = self.clock.time()
+        while self._window and now - self._window[0] >= 1.:
+            self._window.popleft()
+        if len(self._window) >= self.max_rate:
+            self.rejected.append(now)
+            raise ThrottlingError()
+        self._window.append(now)
+        self.accepted.append(now)
+        return {'Reservations': []}
+
+
+def make_limiter(clock, **settings):
+    return throttle.RateLimiter(settings, clock=clock.time, sleep=clock.sleep)
+
+
+def call(limiter, endpoint):
+    return limiter.call(
+        'ec2', 'describe_instances', endpoint.describe_instances)
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    random.seed(0)
+
+
+def test_acquire_does_not_hang_on_rounding_errors():
+    clock = FakeClock()
+    bucket = throttle.AdaptiveTokenBucket(
+        rate=3., min_rate=0.5, max_rate=20., burst=1.,
+        clock=clock.time, sleep=clock.sleep)
+    start = clock.time()
+    for _ in range(100):
+        bucket.acquire()
+    assert clock.time() - start == pytest.approx(99. / 3., rel=1e-3)
+
+
+def test_throughput_is_stable_under_throttling():
+    clock = FakeClock()
+    endpoint = FakeEndpoint(clock, max_rate=10)
+    limiter = make_limiter(clock, rate=5., max_rate=50., burst=10)
+    start = clock.time()
+    while clock.time() - start < 300.:
+        call(limiter, endpoint)
+
+    # After converging, the limiter stays close to the endpoint limit...
+    recent = [t for t in endpoint.accepted if t - start >= 200.]
+    throughput = len(recent) / (clock.time() - start - 200.)
+    assert 5. <= throughput <= 10.
+    # ...without exhausting the retry budget or flooding the endpoint
+    rejected = [t for t in endpoint.rejected if t - start >= 200.]
+    assert len(rejected) < 0.1 * len(recent)
+
+
+def test_rate_drops_after_throttling():
+    clock = FakeClock()
+    endpoint = FakeEndpoint(clock, max_rate=2)
+    limiter = make_limiter(clock, rate=10., burst=10)
+    bucket = limiter.bucket('ec2', 'describe')
+    for _ in range(3):
+        call(limiter, endpoint)
+    assert endpoint.rejected
+    assert bucket.rate < 6.
+
+
+def test_retry_budget_runs_out():
+    clock = FakeClock()
+    endpoint = FakeEndpoint(clock, max_rate=0)
+    limiter = make_limiter(clock, min_retries=4, max_attempts=3)
+    for _ in range(2):
+        with pytest.raises(ThrottlingError):
+            call(limiter, endpoint)
+    # Two calls have used up the budget of four retries
+    assert len(endpoint.rejected) == 6
+    with pytest.raises(ThrottlingError):
+        call(limiter, endpoint)
+    assert len(endpoint.rejected) == 7
+
+
+def test_non_throttling_errors_are_not_retried():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+    calls = []
+
+    def fail():
+        calls.append(clock.time())
+        raise ValueError("Invalid parameter")
+
+    with pytest.raises(ValueError):
+        limiter.call('ec2', 'run_instances', fail)
+    assert len(calls) == 1
+
+
+def test_transient_errors_are_retried():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+    bucket = limiter.bucket('ec2', 'describe')
+    errors = [EndpointConnectionError(), ServerError()]
+
+    def flaky():
+        if errors:
+            raise errors.pop()
+        return {'Reservations': []}
+
+    assert limiter.call('ec2', 'describe_instances', flaky) == \
+        {'Reservations': []}
+    # Transient errors are not a sign of contention
+    assert bucket.rate > 5.
+
+
+def test_mutate_calls_are_not_resent():
+    clock = FakeClock()
+    limiter = make_limiter(clock)
+    calls = []
+
+    def run_instances(error):
+        calls.append(error)
+        if len(calls) == 1:
+            raise error
+        return {'Instances': [{'InstanceId': 'i-{}'.format(len(calls))}]}
+
+    # The request might have launched an instance before timing out...
+    with pytest.raises(ReadTimeoutError):
+        limiter.call('ec2', 'run_instances', run_instances,
+                     ReadTimeoutError())
+    assert len(calls) == 1
+    # ...but it certainly did not if the endpoint was unreachable
+    del calls[:]
+    response = limiter.call('ec2', 'run_instances', run_instances,
+                            EndpointConnectionError())
+    assert response['Instances'][0]['InstanceId'] == 'i-2'
+
+
+def test_only_the_first_config_is_applied(monkeypatch):
+    limiter = throttle.RateLimiter()
+    monkeypatch.setattr(throttle, '_LIMITER', limiter)
+    monkeypatch.setattr(throttle, '_CONFIGURED', False)
+    throttle.configure({'rate': 2.})
+    bucket = limiter.bucket('ec2', 'describe')
+    throttle.configure({'rate': 8.})
+    assert limiter.bucket('ec2', 'describe') is bucket
+    assert bucket.rate == 2.